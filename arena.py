@@ -0,0 +1,34 @@
+class ArenaReader:
+    def __init__(self, stream, arena_size=64*100000):
+        '''
+        Reads a binary stream into large preallocated bytearrays, handing out
+        memoryview slices of them instead of a new bytes object per read.
+        An arena is freed once every slice of it has been released.
+        Wraps a stream for nonblocking.Reader, which calls read1.
+
+        stream: binary stream to read into the arenas
+        arena_size: bytes per arena; reads are at most this large
+        '''
+        self.stream = stream
+        self.arena_size = arena_size
+        # a buffered stream reads large requests straight into the arena, past its own buffer
+        self._readinto = getattr(stream, 'readinto1', None) or stream.readinto
+        self.arena = memoryview(bytearray(arena_size))
+        self.offset = 0
+    @property
+    def closed(self):
+        return self.stream.closed
+    def read1(self, size=-1):
+        if size < 0 or size > self.arena_size:
+            size = self.arena_size
+        if self.offset + size > len(self.arena):
+            # the old arena lives on in the slices still queued or uploading
+            self.arena = memoryview(bytearray(self.arena_size))
+            self.offset = 0
+        count = self._readinto(self.arena[self.offset:self.offset + size])
+        if count is None:
+            # nonblocking stream with nothing ready
+            return None
+        chunk = self.arena[self.offset:self.offset + count]
+        self.offset += count
+        return chunk
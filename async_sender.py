@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# posts DataItems from one asyncio loop over a few keep-alive connections,
+# instead of one blocking request per thread
+
+import asyncio, concurrent.futures, json, socket, ssl, sys, threading, time, urllib.parse
+from ar import ArweaveNetworkException
+from bundlr.node import DEFAULT_API_URL, DEFAULT_CHAIN
+
+class AsyncSender:
+    def __init__(self, api_url=DEFAULT_API_URL, connections=4, window=64, timeout=None, currency=DEFAULT_CHAIN):
+        '''
+        api_url: bundlr node to post to
+        connections: maximum number of keep-alive sockets to the node
+        window: maximum number of items in flight; submitting more blocks the caller
+        timeout: seconds to wait for each response
+        '''
+        url = urllib.parse.urlsplit(api_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == 'https' else None
+        self.path = url.path.rstrip('/') + '/tx/' + currency
+        self.timeout = timeout
+        self.window = window
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.idle = []
+        self.opened = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async_sender', daemon=True)
+        self.thread.start()
+        self.connections = asyncio.run_coroutine_threadsafe(self._make_pool(connections), self.loop).result()
+    async def _make_pool(self, connections):
+        return asyncio.Semaphore(connections)
+
+    @property
+    def full(self):
+        # true while submitters are being held back
+        return self.in_flight >= self.window
+    def wait_below(self, count, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.in_flight < count, timeout)
+
+    def submit(self, data):
+        # data is bytes, or a sequence of buffers that are sent one after another as one body.
+        # blocks while the window is full, so a slow node slows the reader
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < self.window)
+            self.in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(self._send(data), self.loop)
+        future.add_done_callback(self._done)
+        return future
+    def _done(self, future):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+    def send_tx(self, data):
+        # drop-in for bundlr.Node.send_tx
+        return self.submit(data).result()
+    def send_txs(self, datas):
+        # sends all concurrently, returning each result or the exception it raised
+        futures = [self.submit(data) for data in datas]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+    def close(self):
+        async def close_idle():
+            for reader, writer in self.idle:
+                writer.close()
+            self.idle.clear()
+        asyncio.run_coroutine_threadsafe(close_idle(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *params):
+        self.close()
+
+    async def _send(self, data):
+        async with self.connections:
+            if len(self.idle):
+                connection = self.idle.pop()
+            else:
+                connection = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+                connection[1].get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.opened += 1
+            try:
+                status, headers, body = await asyncio.wait_for(self._request(connection, data), self.timeout)
+            except Exception as exc:
+                connection[1].close()
+                if isinstance(exc, asyncio.TimeoutError):
+                    raise ArweaveNetworkException('read timeout', 598, exc, None)
+                raise ArweaveNetworkException(str(exc), None, exc, None)
+            if headers.get('connection', '').lower() == 'close':
+                connection[1].close()
+            else:
+                self.idle.append(connection)
+        text = body.decode(errors='replace')
+        if status != 200:
+            raise ArweaveNetworkException(text, status, None, None)
+        try:
+            return json.loads(text)
+        except Exception as exc:
+            raise ArweaveNetworkException(text, status, exc, None)
+    async def _request(self, connection, data):
+        reader, writer = connection
+        parts = (data,) if isinstance(data, (bytes, bytearray, memoryview)) else data
+        writer.write((
+            f'POST {self.path} HTTP/1.1\r\n'
+            f'Host: {self.host}\r\n'
+            'Content-Type: application/octet-stream\r\n'
+            f'Content-Length: {sum((memoryview(part).nbytes for part in parts))}\r\n'
+            'Connection: keep-alive\r\n'
+            '\r\n'
+        ).encode())
+        # written separately, each part goes to the socket as it is; writelines would join them
+        for part in parts:
+            writer.write(part)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by node')
+        status = int(status_line.split(b' ', 2)[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, val = line.decode().split(':', 1)
+            headers[key.strip().lower()] = val.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            headers['connection'] = 'close'
+        return status, headers, body
+
+if __name__ == '__main__':
+    # compares threaded bundlr.Node posting with AsyncSender against a local stand-in. usage: async_sender.py [items] [item_size] [latency]
+    import os
+    from bundlr import Node
+    from fake_bundlr import FakeBundlr
+    # arguments left off take the defaults in their own positions
+    defaults = [2000, 100000, 0.02]
+    count, size, latency = [*sys.argv[1:4], *defaults[len(sys.argv[1:4]):]]
+    count, size, latency = int(count), int(size), float(latency)
+    payloads = [os.urandom(16) + bytes(size - 16) for idx in range(count)]
+    with FakeBundlr(latency=latency) as server:
+        node = Node(server.url, requests_per_period=None)
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=64) as pool:
+            list(pool.map(node.send_tx, payloads))
+        threaded = time.time() - start
+        threaded_connections = server.stats['connections']
+    payloads = [os.urandom(16) + bytes(size - 16) for idx in range(count)]
+    with FakeBundlr(latency=latency) as server, AsyncSender(server.url, connections=16, window=64) as sender:
+        start = time.time()
+        sender.send_txs(payloads)
+        asynchronous = time.time() - start
+        async_connections = server.stats['connections']
+    print(json.dumps(dict(
+        items = count,
+        item_size = size,
+        latency = latency,
+        threaded = dict(items_per_s = count / threaded, connections = threaded_connections),
+        asyncio = dict(items_per_s = count / asynchronous, connections = async_connections),
+    ), indent=2))
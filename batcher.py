@@ -0,0 +1,71 @@
+import threading, time
+
+class AdaptiveBatcher:
+    def __init__(self, min_count=4, max_count=128, max_linger=2, smoothing=0.25):
+        '''
+        Sizes index batches from the observed input rate and upload latency.
+        Every batch costs extra uploads for its confirmation and index, so
+        slow input is gathered into fuller batches, and bursts are sent in
+        larger ones.
+
+        min_count: fewest chunks to wait for before sending a batch
+        max_count: most chunks to send in one batch
+        max_linger: longest in seconds to wait for a batch to fill
+        smoothing: weight of each new observation in the running averages
+        '''
+        self.min_count = min_count
+        self.max_count = max_count
+        self.max_linger = max_linger
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.rate = None # chunks per second arriving
+        self.latency = None # seconds to upload a batch
+        self.last_arrival = None
+        self.arrivals = 0 # chunks arrived since last_arrival
+        self.rate_window = 0.1 # shortest seconds one rate observation covers, so reads arriving together aren't each their own
+        self.data_bytes = 0
+        self.metadata_bytes = 0
+    def _average(self, old, new):
+        return new if old is None else old + (new - old) * self.smoothing
+    def arrived(self, count, now=None):
+        # called as chunks enter the queue, e.g. once per read
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.last_arrival is None:
+                self.last_arrival = now
+                return
+            self.arrivals += count
+            if now - self.last_arrival >= self.rate_window:
+                self.rate = self._average(self.rate, self.arrivals / (now - self.last_arrival))
+                self.last_arrival = now
+                self.arrivals = 0
+    def uploaded(self, count, data_bytes, metadata_bytes, seconds):
+        # metadata_bytes: confirmation and index payloads sent for the batch
+        with self.lock:
+            self.latency = self._average(self.latency, seconds)
+            self.data_bytes += data_bytes
+            self.metadata_bytes += metadata_bytes
+    def indexed(self, metadata_bytes):
+        with self.lock:
+            self.metadata_bytes += metadata_bytes
+    @property
+    def target(self):
+        # the chunks that arrive during one batch upload, so uploads keep pace
+        if self.rate is None or self.latency is None:
+            return self.min_count
+        return max(self.min_count, min(self.max_count, int(self.rate * self.latency)))
+    def take(self, queued):
+        # how many of the queued chunks to send now
+        return max(1, min(self.max_count, max(queued, self.target)))
+    def linger(self, queued):
+        # how long to wait for more chunks before sending what is queued
+        missing = self.target - queued
+        if missing <= 0:
+            return 0
+        if not self.rate:
+            return self.max_linger
+        return min(self.max_linger, missing / self.rate)
+    @property
+    def overhead(self):
+        # metadata bytes uploaded per captured byte
+        return self.metadata_bytes / self.data_bytes if self.data_bytes else 0
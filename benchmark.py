@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# measures the capture-to-index pipeline against fake_bundlr.py and prints the results as json,
+# so that changes to the pipeline can be compared. each target runs in its own process, so its
+# cpu time and peak rss are its own.
+# usage: benchmark.py [--seconds S] [--rate MBPS] [--latency L] [--error-rate E] [--bandwidth MBPS] [--spill MB] [target ...]
+
+import argparse, json, os, re, shutil, signal, subprocess, sys, tempfile, threading, time
+
+repo = os.path.dirname(os.path.abspath(__file__))
+targets = ('capture_stdin', 'storer', 'send_raws')
+chunk_size = 100000
+
+class Feed:
+    def __init__(self, seconds, rate):
+        '''
+        Unique chunks of chunk_size at a steady rate, with the time each was produced.
+
+        seconds: how long to produce chunks for
+        rate: bytes per second, or 0 for as fast as they are taken
+        '''
+        self.seconds = seconds
+        self.rate = rate
+        self.pool = [os.urandom(chunk_size) for idx in range(16)]
+        self.times = []
+    def __iter__(self):
+        start = time.time()
+        idx = 0
+        while time.time() < start + self.seconds:
+            if self.rate:
+                delay = start + idx * chunk_size / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            # a counter up front, so no two chunks hash alike
+            chunk = idx.to_bytes(8, 'big') + self.pool[idx % len(self.pool)][8:]
+            self.times.append(time.time())
+            yield chunk
+            idx += 1
+
+def percentile(values, fraction):
+    if not len(values):
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(latencies, size, seconds, rusage, dropped_ct = 0, dropped_size = 0):
+    megabytes = size / 1000000
+    return dict(
+        megabytes = megabytes,
+        seconds = seconds,
+        mb_per_s = megabytes / seconds if seconds else None,
+        latency_p50 = percentile(latencies, 0.5),
+        latency_p99 = percentile(latencies, 0.99),
+        indexed_chunks = len(latencies),
+        dropped_reads = dropped_ct,
+        dropped_bytes = dropped_size,
+        cpu_s_per_mb = (rusage.ru_utime + rusage.ru_stime) / megabytes if megabytes else None,
+        peak_rss_mb = rusage.ru_maxrss / 1024,
+    )
+
+def run_capture_stdin(args, env, cwd):
+    # latency is from writing a chunk to stdin until a locator covering its bytes is printed
+    feed = Feed(args.seconds, args.rate * 1000000)
+    proc = subprocess.Popen([sys.executable, os.path.join(repo, 'capture_stdin.py')], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+    locator_times = []
+    batches = [] # (bytes read, bytes dropped before it)
+    dropped = [0, 0]
+    spilled = 0 # most reads waiting on disk at once
+    errors = []
+    def read_stdout():
+        for line in proc.stdout:
+            if line.startswith(b'{'):
+                locator_times.append(time.time())
+    def read_stderr():
+        nonlocal spilled
+        dropped_size = 0
+        for line in proc.stderr:
+            line = line.decode(errors='replace')
+            match = re.search(r'Dropped (\d+) bytes from (\d+) reads', line)
+            if match:
+                dropped_size += int(match[1])
+                dropped[0] += int(match[2])
+                dropped[1] += int(match[1])
+                continue
+            match = re.search(r'(\d+) chunks spilled to disk', line)
+            if match:
+                spilled = max(spilled, int(match[1]))
+                continue
+            match = re.search(r'Read \d+ data chunks \((\d+) bytes\)', line)
+            if match:
+                batches.append((int(match[1]), dropped_size))
+                dropped_size = 0
+                continue
+            errors.append(line)
+    readers = [threading.Thread(target=read_stdout), threading.Thread(target=read_stderr)]
+    for reader in readers:
+        reader.start()
+    offsets = []
+    offset = 0
+    start = time.time()
+    try:
+        for chunk in feed:
+            proc.stdin.write(chunk)
+            offset += len(chunk)
+            offsets.append(offset)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.time() - start
+    for reader in readers:
+        reader.join()
+    latencies = []
+    covered = 0
+    chunk = 0
+    for (size, dropped_size), locator_time in zip(batches, locator_times):
+        covered += size + dropped_size
+        while chunk < len(offsets) and offsets[chunk] <= covered:
+            latencies.append(locator_time - feed.times[chunk])
+            chunk += 1
+    result = summarize(latencies, offset, seconds, rusage, *dropped)
+    result['peak_spilled_reads'] = spilled
+    if os.waitstatus_to_exitcode(status):
+        result['error'] = ''.join(errors[-20:])
+    return result
+
+def child_storer(args):
+    # latency is from putting a chunk in the channel until its result reaches Storer.output for the index loop
+    import multicapture
+    Storer = multicapture.Storer
+    feed = Feed(args.seconds, args.rate * 1000000)
+    size = 0
+    def produce():
+        nonlocal size
+        for chunk in feed:
+            multicapture.inputs.put('benchmark', chunk)
+            size += len(chunk)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    Storer.readers = [producer]
+    with Storer.lock:
+        Storer.scale()
+    latencies = []
+    with Storer.lock:
+        while producer.is_alive() or len(latencies) < len(feed.times):
+            if len(Storer.exceptions):
+                raise Storer.exceptions[0]
+            output = Storer.output['benchmark']
+            now = time.time()
+            while len(output):
+                output.popleft()
+                latencies.append(now - feed.times[len(latencies)])
+            Storer.condition.wait(1)
+    return latencies, size
+
+def child_send_raws(args):
+    # latency is from yielding a chunk until the index append covering it returns
+    import shuffle_hdc
+    feed = Feed(args.seconds, args.rate * 1000000)
+    latencies = []
+    class TimedStorage(shuffle_hdc.ArDItemLengths.BundlrStorage):
+        def finished_data(self, wait=False):
+            for batch, new_idx in super().finished_data(wait):
+                yield batch, new_idx
+                # resumed once send_raws has appended the batch to the index
+                now = time.time()
+                for raw in batch:
+                    latencies.append(now - feed.times[len(latencies)])
+    shuffle_hdc.ArDItemLengths.BundlrStorage = TimedStorage
+    lengths = shuffle_hdc.ArDItemLengths()
+    size = 0
+    def raws():
+        nonlocal size
+        for chunk in feed:
+            size += len(chunk)
+            now = time.time()
+            yield now, chunk, now
+    lengths.send_raws(raws())
+    return latencies, size
+
+def run_child(args, target, env, cwd):
+    command = [
+        sys.executable, os.path.abspath(__file__), '--child', target,
+        '--seconds', str(args.seconds), '--rate', str(args.rate),
+    ]
+    start = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.extend(proc.stderr))
+    stderr_reader.start()
+    stdout = proc.stdout.read()
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.time() - start
+    stderr_reader.join()
+    try:
+        child = json.loads(stdout.splitlines()[-1])
+    except (IndexError, json.JSONDecodeError):
+        child = dict(latencies = [], size = 0, seconds = seconds)
+    result = summarize(child['latencies'], child['size'], child['seconds'], rusage)
+    if os.waitstatus_to_exitcode(status):
+        result['error'] = b''.join(stderr[-20:]).decode(errors='replace')
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the capture-to-index pipeline against a local fake bundler')
+    parser.add_argument('targets', nargs='*', help=f'any of {", ".join(targets)}; all by default')
+    parser.add_argument('--seconds', type=float, default=10, help='how long to feed data for')
+    parser.add_argument('--rate', type=float, default=0, help='input MB/s, 0 for as fast as it is taken')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake bundler seconds per upload')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of uploads the fake bundler fails')
+    parser.add_argument('--bandwidth', type=float, default=0, help='fake bundler MB/s, 0 for unlimited')
+    parser.add_argument('--spill', type=float, default=0, help='MB capture_stdin may spill to disk when its queue is full, 0 to block the input instead')
+    parser.add_argument('--child', choices=targets[1:], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for target in args.targets:
+        if target not in targets:
+            parser.error(f'unknown target {target}')
+    args.targets = args.targets or targets
+
+    if args.child is not None:
+        start = time.time()
+        latencies, size = dict(storer = child_storer, send_raws = child_send_raws)[args.child](args)
+        print(json.dumps(dict(latencies = latencies, size = size, seconds = time.time() - start)), flush=True)
+        # storers and readers are not daemon threads
+        os._exit(0)
+
+    import ar
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(repo, 'fake_bundlr.py'), '0', str(args.latency), str(args.error_rate), str(args.bandwidth * 1000000)],
+        stdout=subprocess.PIPE, text=True
+    )
+    url = server.stdout.readline().split()[2]
+    env = dict(os.environ, BUNDLR_URL = url, GATEWAY_URL = url, PYTHONUNBUFFERED = '1', PYTHONPATH = os.pathsep.join((repo, os.environ.get('PYTHONPATH', ''))))
+    if args.spill:
+        env['SPILL_BUDGET'] = str(int(args.spill * 1000000))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ar.Wallet.generate(jwk_file=os.path.join(tmpdir, 'identity.json'))
+        for target in args.targets:
+            # a fresh directory each, so journals and spills don't carry over
+            cwd = os.path.join(tmpdir, target)
+            os.mkdir(cwd)
+            shutil.copy(os.path.join(tmpdir, 'identity.json'), cwd)
+            if target == 'capture_stdin':
+                results[target] = run_capture_stdin(args, env, cwd)
+            else:
+                results[target] = run_child(args, target, env, cwd)
+    server.send_signal(signal.SIGINT)
+    server_stats = json.loads(server.stdout.read().strip().splitlines()[-1])
+    server.wait()
+    print(json.dumps(dict(
+        config = dict(seconds = args.seconds, rate = args.rate, latency = args.latency, error_rate = args.error_rate, bandwidth = args.bandwidth, spill = args.spill, chunk_size = chunk_size),
+        server = server_stats,
+        results = results,
+    ), indent=2))
+
+if __name__ == '__main__':
+    main()
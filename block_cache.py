@@ -0,0 +1,79 @@
+import json, sqlite3, threading, time
+
+class BlockCache:
+    def __init__(self, path, max_size=256*1024*1024):
+        '''
+        A persistent cache of what is learned crawling the chain, so that
+        repeat downloads and resumes don't crawl it again.
+        Values are json, grouped by kind: e.g. 'height' by block hash,
+        'bundles' by block height, 'header' by bundle txid.
+
+        path: sqlite database file
+        max_size: approximate bytes of values to keep; the least recently
+                  used are evicted past it
+        '''
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (kind TEXT, key, value TEXT, size INTEGER, used REAL, PRIMARY KEY (kind, key))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    def __enter__(self):
+        return self
+    def __exit__(self, *params):
+        self.close()
+    def get(self, kind, key, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM entries WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+            if row is None:
+                return default
+            self.db.execute('UPDATE entries SET used = ? WHERE kind = ? AND key = ?', (time.time(), kind, key))
+            return json.loads(row[0])
+    def put(self, kind, key, value):
+        value = json.dumps(value)
+        with self.lock:
+            old = self.db.execute('SELECT size FROM entries WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (kind, key, value, len(value), time.time()))
+            self.size += len(value) - (old[0] if old is not None else 0)
+            if self.size > self.max_size:
+                self._evict(self.max_size * 3 // 4)
+    def put_many(self, kind, items):
+        # one transaction for many values, e.g. every dataitem of a bundle
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                now = time.time()
+                for key, value in items:
+                    value = json.dumps(value)
+                    old = self.db.execute('SELECT size FROM entries WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+                    self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (kind, key, value, len(value), now))
+                    self.size += len(value) - (old[0] if old is not None else 0)
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            if self.size > self.max_size:
+                self._evict(self.max_size * 3 // 4)
+    def discard_from(self, kind, min_key):
+        # drops entries at or past min_key, e.g. blocks that may be reorganised
+        with self.lock:
+            self.db.execute('DELETE FROM entries WHERE kind = ? AND key >= ?', (kind, min_key))
+            self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    def _evict(self, target_size):
+        # needs lock
+        while self.size > target_size:
+            rows = self.db.execute('SELECT kind, key, size FROM entries ORDER BY used LIMIT 256').fetchall()
+            if not len(rows):
+                break
+            evicted = []
+            for kind, key, size in rows:
+                if self.size <= target_size:
+                    break
+                evicted.append((kind, key))
+                self.size -= size
+            self.db.executemany('DELETE FROM entries WHERE kind = ? AND key = ?', evicted)
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -13,11 +13,21 @@ import hashlib
 from ar import Peer, Wallet, DataItem, ArweaveNetworkException
 from ar.utils import create_tag
 from bundlr import Node
+from bundlr.node import DEFAULT_API_URL
 # indexes a balanced tree of past indices
 from flat_tree import flat_tree, __version__ as flat_tree_version
+from pipeline import OrderedPipeline
+from async_sender import AsyncSender
+from signing import SigningPool
+from retry import RetryPolicy
+from spill import SpillQueue
+from journal import Journal
+from batcher import AdaptiveBatcher
+from arena import ArenaReader
 
 #print('warning: this script hopefully works but drops chunks due to waiting on network and not buffering input')
 import nonblocking_stream_queue as nonblocking
+from collections import deque
 
 try:
     wallet = Wallet('identity.json')
@@ -36,27 +46,66 @@ else:
         fh = os.fdopen(int(sys.argv[1]), 'rb')
     except:
         fh = open(sys.argv[1], 'rb')
+signing_workers = None # a number of processes to sign DataItems in, instead of under the GIL
+# the workers fork here, before the reader starts a thread that forking could copy mid-read
+signer = SigningPool('identity.json', signing_workers) if signing_workers else None
+spill_budget = int(os.environ.get('SPILL_BUDGET', 0)) or None # bytes of local disk to spill overflowing reads into instead of dropping them
+if spill_budget:
+    # reads the memory queue can't hold are appended here, oldest first, and uploaded before newer ones
+    spill = SpillQueue(os.path.basename(__file__).rsplit('.',1)[0]+'_spill', spill_budget)
+    spill_positions = deque()
+else:
+    spill = None
+min_at_once = 4 # chunks to wait up to max_linger for before indexing a batch
+max_at_once = 128 # most chunks in one index batch; batches are sized between these from upload latency and input rate
+max_linger = 2 # seconds to wait for a batch to fill when input is slow
+batcher = AdaptiveBatcher(min_at_once, max_at_once, max_linger)
+def post_read(tuple):
+    # reads are counted as they arrive from the input, not as batches are taken from the queue
+    now = time.time()
+    batcher.arrived(1, now)
+    return (*tuple, now)
+chunk_size = 100000 # largest read, uploaded as one DataItem
+arena_size = 64*chunk_size # reads land in preallocated buffers of this size, which chunks are views of
 reader = nonblocking.Reader(
-    fh,
-    max_size=100000,
+    ArenaReader(fh, arena_size),
+    max_size=chunk_size,
     lines=False,
     #lines=True,
     max_count=16*1024,#256, #1024, # max number queued
-    drop_timeout=None, #0, # max time to wait adding to queue when full (waits forever if None)
+    drop_timeout=0 if spill is not None else None, # max time to wait adding to queue when full (waits forever if None); a full queue spills at once
     drop_older=True,
     pre_cb=lambda: time.time(),
-    post_cb=lambda tuple: (*tuple, time.time()),
+    post_cb=post_read,
+    drop_cb=spill.append if spill is not None else None,
     verbose=True,
 )
-max_at_once = 32#64
+upload_workers = 4 # concurrent chunk uploads shared by all batches
+pending_batches = 2 # batches uploading while the oldest is indexed
+async_connections = None # a number of keep-alive sockets to post from an asyncio loop instead of threads
+async_window = 256 # items in flight before the asyncio sender holds back further uploads
+retry_policy = RetryPolicy(deadline=None) # shared backoff and circuit breaker; a deadline in seconds gives up on items
+journal_path = os.path.basename(__file__).rsplit('.',1)[0]+'.journal' # uploads and index appends, to continue the stream after a crash; None disables
+gateway_url = os.environ.get('GATEWAY_URL', 'https://ar-io.dev') # benchmark.py points these at fake_bundlr.py
+bundlr_url = os.environ.get('BUNDLR_URL', DEFAULT_API_URL)
 #capture = sys.stdin.buffer
 
 class BundlrStorage:
-    def __init__(self, **tags):
+    def __init__(self, max_workers=4, max_pending=2, async_connections=None, async_window=256, signer=None, retry_policy=None, batcher=None, **tags):
         #self.peer = Peer()
-        self.peer = Peer('https://ar-io.dev', timeout=240)#)
-        self.node = Node(timeout=240)#60)
+        self.peer = Peer(gateway_url, timeout=240)#)
+        self.node = Node(bundlr_url, timeout=240)#60)
+        self.sender = AsyncSender(self.node.api_url, async_connections, async_window, timeout=240) if async_connections else None
+        self.signer = signer
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.batcher = batcher
         self.tags = tags
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='send')
+        self.pipeline = OrderedPipeline(max_pending, 'store_data')
+        self.journal = None
+        self.sent = {} # sha256 -> result of chunks uploaded before a restart
+        self.replay = deque() # store_index results to hand back while rebuilding the tree
+        self.stored_indices = []
         self._current_block = self.peer.block_current()
         self._last_block_time = time.time()
     @property
@@ -70,16 +119,21 @@ class BundlrStorage:
                 pass
         return self._current_block
     def store_index(self, metadata):
+        if len(self.replay):
+            return self.replay.popleft()
         data = json.dumps(metadata).encode()
         result = self.send(data)
-        confirmation = self.send(json.dumps(result).encode())
+        confirmation = json.dumps(result).encode()
+        if self.batcher is not None:
+            self.batcher.indexed(len(data) + len(confirmation))
+        confirmation = self.send(confirmation)
         sha256 = hashlib.sha256()
         sha256.update(data)
         sha256 = sha256.hexdigest()
         blake2b = hashlib.blake2b()
         blake2b.update(data)
         blake2b = blake2b.hexdigest()
-        return dict(
+        result = dict(
             ditem = [result['id']],
             min_block = (self.current_block['height'], self.current_block['indep_hash']),
             #api_block = result['block'],
@@ -87,15 +141,56 @@ class BundlrStorage:
             sha256 = sha256,
             blake2b = blake2b,
         )
-    def store_data(self, raws):
-        global last_post_time # so it can start prior to imports
-        global dropped_ct, dropped_size # for quick implementation
+        self.stored_indices.append(result)
+        return result
+    def queue_data(self, raws, dropped=None):
+        # uploads in the background; results come back in order from finished_data
+        self.pipeline.submit(lambda: (raws, self.store_data(raws, dropped)))
+    def finished_data(self, wait=False):
+        return self.pipeline.completed(wait)
+    def shutdown(self):
+        self.pipeline.shutdown()
+        self.pool.shutdown()
+        if self.sender is not None:
+            self.sender.close()
+        if self.signer is not None:
+            self.signer.close()
+    def store_data(self, raws, dropped=None):
         #data_array = []
         #for offset in range(0,len(raw),100000):
         #    data_array.append(send(raw[offset:offset+100000]))
         #data_array = [self.send(raw) for pre_time, raw, post_time in raws]
-        data_array = list(concurrent.futures.ThreadPoolExecutor(max_workers=4).map(self.send, [raw for pre_time, raw, post_time in raws]))
-        confirmation = self.send(json.dumps(data_array).encode())
+        start = time.time()
+        datas = [raw for pre_time, raw, post_time in raws]
+        if self.journal is not None:
+            # chunks uploaded before a restart are not uploaded again
+            digests = [hashlib.sha256(raw).hexdigest() for raw in datas]
+            data_array = [self.sent.pop(digest, None) for digest in digests]
+        else:
+            data_array = [None for raw in datas]
+        unsent = [idx for idx, data in enumerate(data_array) if data is None]
+        if self.sender is not None:
+            # every chunk goes out at once over the sender's pooled connections
+            dis = self.sign_many([datas[idx] for idx in unsent])
+            sent = self.send_signed_many(dis)
+        else:
+            sent = self.pool.map(self.send, [datas[idx] for idx in unsent])
+        for idx, data in zip(unsent, sent):
+            data_array[idx] = data
+            if self.journal is not None:
+                self.journal.append(dict(
+                    type = 'ditem',
+                    sha256 = digests[idx],
+                    length = len(datas[idx]),
+                    time = time.time(),
+                    result = data,
+                ), sync=False)
+        if self.journal is not None:
+            self.journal.sync()
+        confirmation = json.dumps(data_array).encode()
+        if self.batcher is not None:
+            self.batcher.uploaded(len(raws), sum((len(raw) for raw in datas)), len(confirmation), time.time() - start)
+        confirmation = self.send(confirmation)
         sha256 = hashlib.sha256()
         for pre, raw, post in raws:
           sha256.update(raw)
@@ -114,24 +209,55 @@ class BundlrStorage:
             rcpt = confirmation['id'],
             sha256 = sha256,
             blake2b = blake2b,
-            dropped = dict(
-                count = dropped_ct,
-                size = dropped_size,
-                time = last_post_time,
-            ) if dropped_ct else None,
+            dropped = dropped,
         )
-    def send(self, data, **tags):
-        di = ar.DataItem(data = data)
-        di.header.tags = [
+    def sign(self, data, **tags):
+        tags = [
             create_tag(key, val, True)
             for key, val in {**self.tags, **tags}.items()
         ]
+        if self.signer is not None:
+            return self.signer.sign(data, tags)
+        di = ar.DataItem(data = data)
+        di.header.tags = tags
         di.sign(wallet.rsa)
-        while True:
+        return di
+    def sign_many(self, datas, **tags):
+        if self.signer is not None:
+            return self.signer.sign_many(datas, [
+                create_tag(key, val, True)
+                for key, val in {**self.tags, **tags}.items()
+            ])
+        return [self.sign(data, **tags) for data in datas]
+    def send(self, data, **tags):
+        return self.send_signed(self.sign(data, **tags))
+    def payload(self, di):
+        # the asyncio sender writes the header and the chunk's own buffer out without joining them
+        if self.sender is not None:
+            return (di.header.tobytes(), di.data)
+        return di.tobytes()
+    def send_signed_many(self, dis):
+        # sends all at once when the node is up, and retries the ones that fail one at a time
+        breaker = self.retry_policy.breaker
+        deadline = time.time() + self.retry_policy.deadline if self.retry_policy.deadline is not None else None
+        if not breaker.wait(deadline):
+            raise TimeoutError(f'circuit open past deadline of {self.retry_policy.deadline}s')
+        results = self.sender.send_txs([self.payload(di) for di in dis])
+        # the batch counts as one call, which also releases a probe
+        if all((isinstance(result, Exception) for result in results)) and len(results):
+            breaker.failure()
+        else:
+            breaker.success()
+        return [
+            self.send_signed(di) if isinstance(result, Exception) else result
+            for di, result in zip(dis, results)
+        ]
+    def send_signed(self, di):
+        sender = self.node if self.sender is None else self.sender
+        def attempt():
             try:
                 start = time.time()
-                result = self.node.send_tx(di.tobytes())
-                break
+                return sender.send_tx(self.payload(di))
             except ar.ArweaveNetworkException as exc:
                 message, status_code, cause, response = exc.args
                 if status_code == 201: # transaction already received
@@ -141,13 +267,14 @@ class BundlrStorage:
                     )
                 logging.exception(exc)
                 print(exc, file=sys.stderr)
-                continue
+                raise
             except Exception as exc:
                 print(exc, file=sys.stderr)
-                continue
-        return result
+                raise
+        # backs off, and waits with every other sender while the node is down
+        return self.retry_policy.call(attempt)
 
-bundlrstorage = BundlrStorage()
+bundlrstorage = BundlrStorage(upload_workers, pending_batches, async_connections, async_window, signer, retry_policy, batcher)
 first = None
 start_block = None
 prev_indices_id = None
@@ -158,36 +285,24 @@ else: # took a storage object
     indices = flat_tree(bundlrstorage, 3)
 #index_values = indices
 
-#dump = open('dump.bin', 'wb')
-while reader.block():
-    #raw = capture.read(100000*16)#100000)
-    #reader.block()
-    with reader:
-        dropped_ct, dropped_size = reader.dropped(reset = True)
-        raws = reader.read_many(max_at_once)
-    sys.stderr.write(f'Read {len(raws)} data chunks\n')
-    if dropped_ct:
-        sys.stderr.write(f'Dropped {dropped_size} bytes from {dropped_ct} reads at {last_post_time}\n')
-    sys.stderr.flush()
-    #for start_time, raw, end_time in raws:
-    #    dump.write(raw)
-    #if len(raw) == 0:
-    #    break
+def index_data(raws, data):
+    global prev_indices_id, first, start_block
+    bundlrstorage.stored_indices = []
+    metadata = None
     if flat_tree_version in ('0.0.0', '0.0.1'): # took an index id
         indices.append(
             prev_indices_id,
             sum((len(raw) for pre_time, raw, post_time in raws)),
-            bundlrstorage.store_data(raws)
+            data
         )
         metadata = indices.snap()#[(type, data, start, size) for type, data, start, size, *_ in indices]
         prev_indices_id = bundlrstorage.store_index(metadata)
     else: # took a storage object
         indices.append(
             sum((len(raw) for pre_time, raw, post_time in raws)),
-            bundlrstorage.store_data(raws)
+            data
         )
         prev_indices_id = indices.locator
-    last_pre_time, last_raw, last_post_time = raws[-1]
     #offset += len(raw)
     #indices.append(dict(dataitem=prev, current_block=current_block['indep_hash'])#, end_offset=offset), )
 
@@ -195,6 +310,19 @@ while reader.block():
         first = prev_indices_id['ditem'][0]
         start_block = bundlrstorage.current_block['indep_hash']
 
+    if journal is not None:
+        # journaled before the locator is handed out, so the append can be replayed
+        journal.append(dict(
+            type = 'append',
+            size = sum((len(raw) for pre_time, raw, post_time in raws)),
+            data = data,
+            snap = metadata,
+            indices = bundlrstorage.stored_indices,
+            locator = prev_indices_id,
+            first = first,
+            start_block = start_block,
+        ))
+
     #eta = current_block['timestamp'] + (result['block'] - current_block['height']) * 60 * 2
     #eta = datetime.fromtimestamp(eta)
     #index_values = [value for leaf_count, value in indices]
@@ -207,3 +335,95 @@ while reader.block():
     #json.dump(index_values[-1], sys.stdout)
     json.dump(prev_indices_id, sys.stdout)
     sys.stdout.write('\n')
+
+journal = Journal(journal_path) if journal_path else None
+if journal is not None:
+    if journal.ended:
+        # the last stream finished cleanly; start a new one
+        journal.rewrite([])
+    appends = [record for record in journal.records if record['type'] == 'append']
+    indexed = set()
+    for record in appends:
+        if flat_tree_version in ('0.0.0', '0.0.1'): # took an index id
+            indices = flat_tree(3, record['snap'])
+        else: # took a storage object
+            bundlrstorage.replay.extend(record['indices'])
+            indices.append(record['size'], record['data'])
+            indices.locator
+        indexed.update(record['data']['capture']['ditem'])
+        prev_indices_id, first, start_block = record['locator'], record['first'], record['start_block']
+    assert not len(bundlrstorage.replay)
+    ditems = [
+        record for record in journal.records
+        if record['type'] == 'ditem' and record['result']['id'] not in indexed
+    ]
+    bundlrstorage.sent = {record['sha256']: record['result'] for record in ditems}
+    journal.rewrite([*appends, *ditems])
+    bundlrstorage.journal = journal
+    if first is not None:
+        sys.stderr.write(f'Resuming stream {first} from its journal\n')
+
+#dump = open('dump.bin', 'wb')
+while (spill is not None and len(spill)) or reader.block():
+    #raw = capture.read(100000*16)#100000)
+    #reader.block()
+    queued = len(reader) + (len(spill) if spill is not None else 0)
+    linger = batcher.linger(queued)
+    if linger:
+        # slow input: wait a little for a fuller batch, so index uploads are paid less often
+        reader.block(linger, batcher.target - queued + len(reader))
+    with reader:
+        dropped_ct, dropped_size = reader.dropped(reset = True)
+        at_once = batcher.take(len(reader) + (len(spill) if spill is not None else 0))
+        if spill is not None:
+            # spilled reads are older than anything still queued in memory
+            dropped_ct, dropped_size = spill.dropped(reset = True)
+            raws = spill.read_many(at_once)
+            raws.extend(reader.read_many(at_once - len(raws)))
+            spill_position = spill.position
+        else:
+            raws = reader.read_many(at_once)
+    if not len(raws):
+        continue
+    if spill is not None:
+        # committed once this batch is stored, so only batches that are sent have a position
+        spill_positions.append(spill_position)
+    if spill is not None and len(spill):
+        sys.stderr.write(f'{len(spill)} chunks spilled to disk\n')
+    sys.stderr.write(f'Read {len(raws)} data chunks ({sum((len(raw) for pre_time, raw, post_time in raws))} bytes), batch target {batcher.target}, metadata overhead {batcher.overhead:.2%}\n')
+    retry_stats = retry_policy.stats
+    if retry_stats['retries']:
+        sys.stderr.write('Upload retries: {retries} taking {retry_time:.1f}s, {giveups} given up, circuit opened {circuit_opens} times\n'.format(**retry_stats))
+    if bundlrstorage.sender is not None and bundlrstorage.sender.full:
+        # uploads wait on the window, not the reader; reads pile up behind them
+        if spill is not None:
+            sys.stderr.write(f'Upload window full, reads queue in memory and then spill to disk\n')
+        else:
+            sys.stderr.write(f'Upload window full, reads queue in memory and then input waits\n')
+    if dropped_ct:
+        sys.stderr.write(f'Dropped {dropped_size} bytes from {dropped_ct} reads at {last_post_time}\n')
+    sys.stderr.flush()
+    #for start_time, raw, end_time in raws:
+    #    dump.write(raw)
+    #if len(raw) == 0:
+    #    break
+    # batch N+1 uploads while batch N is confirmed and appended to the index
+    bundlrstorage.queue_data(raws, dict(
+        count = dropped_ct,
+        size = dropped_size,
+        time = last_post_time,
+    ) if dropped_ct else None)
+    last_pre_time, last_raw, last_post_time = raws[-1]
+    for raws, data in bundlrstorage.finished_data():
+        index_data(raws, data)
+        if spill is not None:
+            spill.commit(spill_positions.popleft())
+for raws, data in bundlrstorage.finished_data(wait=True):
+    index_data(raws, data)
+    if spill is not None:
+        spill.commit(spill_positions.popleft())
+bundlrstorage.shutdown()
+if spill is not None:
+    spill.close()
+if journal is not None:
+    journal.close(ended=True)
@@ -0,0 +1,64 @@
+import threading
+from collections import deque
+
+class Channel:
+    def __init__(self, capacity=256):
+        '''
+        A bounded multi-producer multi-consumer queue with a sub-queue per source.
+        get() takes from the sources in turn, so a chatty source can't starve
+        a quiet one, and put() blocks a source whose sub-queue is full.
+
+        capacity: items each source may have queued before its put() blocks
+        '''
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.queues = {} # source -> deque of items
+        self.ready = deque() # sources with queued items, in the order they are served
+        self.count = 0
+        self.seq = 0
+        self.closed = False
+    def __len__(self):
+        return self.count
+    def depth(self, source):
+        queue = self.queues.get(source)
+        return len(queue) if queue is not None else 0
+    def put(self, source, item, timeout=None):
+        # returns False if the sub-queue stayed full for timeout seconds, or the channel is closed
+        with self.lock:
+            queue = self.queues.setdefault(source, deque())
+            if not self.not_full.wait_for(lambda: len(queue) < self.capacity or self.closed, timeout):
+                return False
+            if self.closed:
+                return False
+            if not len(queue):
+                self.ready.append(source)
+            queue.append(item)
+            self.count += 1
+            self.not_empty.notify()
+            return True
+    def get(self, timeout=None):
+        # returns (seq, source, item), or None on timeout or once closed and drained
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: self.count or self.closed, timeout):
+                return None
+            if not self.count:
+                return None
+            source = self.ready.popleft()
+            queue = self.queues[source]
+            item = queue.popleft()
+            if len(queue):
+                self.ready.append(source)
+            self.count -= 1
+            seq = self.seq
+            self.seq += 1
+            # producers of every source share the condition
+            self.not_full.notify_all()
+            return seq, source, item
+    def close(self):
+        # wakes every waiter; queued items can still be taken
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
 import datetime
-import itertools, logging, sys, time
+import argparse, bisect, concurrent.futures, hashlib, io, itertools, logging, os, queue, sys, threading, time
 import json
+import watchdog.observers, watchdog.events
+import zstandard as zstd
+from collections import OrderedDict
 #from flat_tree import flat_tree, __version__ as flat_tree_version
 from flat_tree.append_indices import append_indices
 from ar import Block, Transaction, Peer, DataItem, ANS104BundleHeader, ANS104DataItemHeader, ArweaveException, ArweaveNetworkException, logger
 import ar.utils
+from pipeline import OrderedPipeline
+from block_cache import BlockCache
 try:
     from tqdm import tqdm
 except:
@@ -16,37 +21,68 @@ except:
 
 #logging.basicConfig(level=logging.DEBUG)
 
-logging.warning('Note: this script downloads without verifying data integrity. Not that hard to add integrity checks into pyarweave\'s peer stream class.')
+cache_path = os.path.basename(__file__).rsplit('.',1)[0]+'_cache.sqlite' # blocks and bundle headers already crawled; None disables
+cache_size = 256*1024*1024 # bytes of cache to keep before evicting the least recently used
+
+class IntegrityError(Exception):
+    pass
 
 #logging.basicConfig(level = logging.DEBUG)
 
 class Stream:
-    def __init__(self, metadata, peer, follow_owner = True):
+    def __init__(self, metadata, peer, follow_owner = True, prefetch = 16, cache = None, scan_workers = 16, scan_heights = 4, open_bundles = 8, location_count = 1024*1024, verify = True, verify_workers = os.cpu_count()):
         self.peer = peer
+        self.verify = verify # check dataitem signatures and the digests stored with each index and leaf
+        self.verify_workers = verify_workers # leaves checked concurrently while later ones download
+        self.cache = cache # a BlockCache shared between runs, or None
+        self.scan_heights = scan_heights # blocks scanned ahead of the one being searched
+        self.scan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=scan_workers, thread_name_prefix='scan') # tx tags and bundle headers
+        self.block_pool = concurrent.futures.ThreadPoolExecutor(max_workers=scan_heights, thread_name_prefix='block') # whole blocks, which use scan_pool
+        self.block_futures = {}
+        self.block_futures_lock = threading.Lock()
+        self.prefetch = prefetch # dataitems fetched concurrently ahead of the one being yielded
+        self.lock = threading.Lock() # held while walking the chain, which shares the caches
         self.channels = set()
         self.height_cache = {}
         self.bundle_cache = {}
-        self.cached_bundle = None
+        # the caches are filled from block_pool threads. not self.lock, which is held while waiting on them.
+        self.cache_lock = threading.Lock()
+        self.locations = OrderedDict() # id -> (bundle, start, end) for every dataitem of every bundle header parsed
+        self.locations_lock = threading.Lock()
+        self.location_count = location_count
+        self.bundle_streams = OrderedDict() # bundle -> idle open streams, least recently used first
+        self.bundle_streams_lock = threading.Lock()
+        self.open_bundles = open_bundles
+        self.nodes = OrderedDict() # recently parsed index nodes, for seeking
         self.follow_owner = follow_owner
         self.tail_height = 0
         self.follow_owner = follow_owner
         self.tail = None
         self.update_tail(metadata)
     def update_tail(self, metadata):
+        # returns True if the stream was extended. tails from other owners, or that
+        # would shorten the stream, are ignored once there is a tail to follow.
         old_tail = self.tail
         if type(metadata) is list:
             # full metadata for an ending range
-            self.tail = metadata
-            guess_owner_metadata = [item for item in self.tail if item[0] > 0][-1][1] # find endmost non-leaf index
+            tail = metadata
+            guess_owner_metadata = [item for item in tail if item[0] > 0][-1][1] # find endmost non-leaf index
         elif 'ditem' in metadata:
-            self.tail = sum((self.dataitem_json(ditem, metadata['min_block']) for ditem in metadata['ditem']), start=[])
+            tail = self._node_entries(metadata)
             guess_owner_metadata = metadata
         else:
             raise AssertionError('unexpected metadata structure', metadata)
-        if self.follow_owner is True:
+        if self.follow_owner is not False:
             ditem_header, ditem_stream, ditem_size = self.dataitem(guess_owner_metadata['ditem'][-1], guess_owner_metadata['min_block'])
-            self.follow_owner = ditem_header.owner
-            logger.warning(f'following not implemented yet, but guessing owner to follow as {self.follow_owner} !')
+            if self.follow_owner is True:
+                self.follow_owner = ditem_header.owner
+            elif ditem_header.owner != self.follow_owner:
+                logger.warning(f'ignoring a tail from {ditem_header.owner}, following {self.follow_owner}')
+                return False
+        if old_tail is not None and sum((size for leaf_count, data, start, size, *_ in tail)) < len(self):
+            logger.warning('ignoring a tail shorter than the stream')
+            return False
+        self.tail = tail
         return self.tail != old_tail
     def __len__(self):
         #self.poll()
@@ -57,6 +93,51 @@ class Stream:
     #                finds blocks that have no content. maybe it could take a dummy parameter?
     #    #if self.follow_owner and self.peer.height() > self.tail_height:
     def iterate(self):
+        # yields (index, channel_name, time, header, stream, length) of every chunk in stream order.
+        # each leaf is held back until the digests stored with it are checked on a worker,
+        # while the leaves after it download.
+        if not self.verify:
+            yield from self._iterate()
+            return
+        with OrderedPipeline(self.verify_workers, 'verify') as checker:
+            leaf = []
+            for item in self._iterate():
+                if len(leaf) and item[0] is not leaf[0][0]:
+                    checker.submit(self._verified_leaf, leaf)
+                    leaf = []
+                    for items in checker.completed():
+                        yield from items
+                leaf.append(item)
+            if len(leaf):
+                checker.submit(self._verified_leaf, leaf)
+            for items in checker.completed(wait=True):
+                yield from items
+    def _verified_leaf(self, items):
+        # the chunks of a leaf, fetched once more if they don't match its digests
+        data = items[0][0]
+        if self._digests_match(data, [stream.getvalue() for index, channel_name, time, header, stream, length in items if channel_name == 'capture']):
+            return items
+        logger.warning(f'leaf {data.get("rcpt")} does not match its stored digests, fetching it again')
+        ditems = iter(data['capture']['ditem'])
+        items = [
+            self._leaf_item(index, channel_name, time, next(ditems), refetch = True) if channel_name == 'capture' else (index, channel_name, time, header, stream, length)
+            for index, channel_name, time, header, stream, length in items
+        ]
+        if self._digests_match(data, [stream.getvalue() for index, channel_name, time, header, stream, length in items if channel_name == 'capture']):
+            return items
+        raise IntegrityError('leaf does not match its stored digests', data.get('rcpt'))
+    @staticmethod
+    def _digests_match(data, raws):
+        # whichever digests capture_stdin.py and shuffle_hdc.py stored over the record's dataitems
+        for name in ('sha256', 'blake2b'):
+            if name in data:
+                digest = hashlib.new(name)
+                for raw in raws:
+                    digest.update(raw)
+                if digest.hexdigest() != data[name]:
+                    return False
+        return True
+    def _iterate(self):
         # this function is the guts of a class that wraps a tree root record
         # indexing binary data on a blockchain. it is intended to yield the
         # chunks in order when called.
@@ -80,6 +161,10 @@ class Stream:
         #           index      stream offset  index offset  region size
         indices = [(self.tail, 0,             0,            total_size)]
 
+        # leaf dataitems are fetched concurrently, and handed back in stream order
+        prefetcher = OrderedPipeline(self.prefetch, 'prefetch')
+        yielded_size = 0
+
         while len(indices):
             index, index_offset, index_start, index_size = indices[-1]
             index_offset_in_stream = index_offset - index_start
@@ -90,7 +175,7 @@ class Stream:
                         for ditem in index['ditem']:
                             assert ditem not in visited
                             visited[ditem] = indices.copy()
-                        ditem = sum((self.dataitem_json(ditem, index['min_block']) for ditem in index['ditem']), start=[])
+                        ditem = self.index_node(index)
                         # after appending, it is not processing correct region
                         #print('adding', ditem)
                         indices.append((ditem, index_offset_in_stream, index_substart, index_subsize))
@@ -102,7 +187,6 @@ class Stream:
                             if type(channel_data) is dict and 'ditem' in channel_data:
                                 sys.stderr.write(f'yielding {channel_name} @ {stream_output_offset}\n')
                                 self.channels.add(channel_name)
-                                length_sum = 0
                                 if 'time' in channel_data:
                                     times = channel_data['time']
                                 else:
@@ -111,17 +195,15 @@ class Stream:
                                     if type(ditem) is not dict:
                                         assert ditem not in visited
                                         visited[ditem] = indices.copy()
-                                        header, stream, length = self.dataitem(ditem, index['min_block'])
-                                    else:
-                                        header, stream, length = (None, ditem, 1)
-                                    length_sum += length
-                                    #assert length > 0
-                                    yield index, channel_name, time, header, stream, length
+                                    prefetcher.submit(self._leaf_item, index, channel_name, time, ditem)
+                                    for item in prefetcher.completed():
+                                        if item[1] == 'capture':
+                                            yielded_size += item[-1]
+                                        yield item
                                     #print(index_offset_in_stream, stream_output_offset, index['capture']['ditem'])
-                                    if channel_name == 'capture':
-                                        stream_output_offset += length
                                 if channel_name == 'capture':
-                                    assert index_subsize == length_sum
+                                    # a leaf's chunks sum to its size, so the walk can go on before they arrive
+                                    stream_output_offset += index_subsize
                 else:
                     #print('skipping', index)
                     assert index_offset_in_stream <= stream_output_offset
@@ -130,8 +212,129 @@ class Stream:
                 #print('popping')
                 assert stream_output_offset == expected_stream_output_offset
                 indices.pop()
+        for item in prefetcher.completed(wait=True):
+            if item[1] == 'capture':
+                yielded_size += item[-1]
+            yield item
+        prefetcher.shutdown()
         assert stream_output_offset == total_size
         assert index_offset_in_stream == total_size
+        assert yielded_size == total_size
+    def index_node(self, data):
+        # the entries of the index node an inner entry points to
+        key = tuple(data['ditem'])
+        node = self.nodes.get(key)
+        if node is None:
+            node = self._node_entries(data)
+            self.nodes[key] = node
+            while len(self.nodes) > 256:
+                self.nodes.popitem(last=False)
+        return node
+    def _node_entries(self, data):
+        # reads an index record's dataitems, fetching them once more if they don't match its digests
+        for attempt in range(2):
+            raws = [self.dataitem(ditem, data['min_block'], refetch = attempt > 0)[1].getvalue() for ditem in data['ditem']]
+            if not self.verify or self._digests_match(data, raws):
+                return sum((json.loads(raw) for raw in raws), start=[])
+            logger.warning(f'index {data["ditem"]} does not match its stored digests')
+        raise IntegrityError('index does not match its stored digests', data['ditem'])
+    def leaf_at(self, offset):
+        # descends straight to the leaf covering a stream offset, fetching only the index nodes on the way.
+        # returns the stream offset of the leaf, its size, and its data.
+        index, index_offset, index_start = self.tail, 0, 0
+        if not 0 <= offset < len(self):
+            raise IndexError('offset outside stream', offset)
+        while True:
+            for entry_offset, leaf_count, data, start, size in self._region_entries(index, index_offset, index_start):
+                if offset < entry_offset + size:
+                    break
+            else:
+                raise AssertionError('no index entry covers offset', offset)
+            if leaf_count == 0:
+                return entry_offset, size, data
+            index, index_offset, index_start = self.index_node(data), entry_offset, start
+    def _region_entries(self, index, index_offset, index_start):
+        # yields (stream offset, leaf_count, data, start, size) of the entries of a node that cover its region.
+        # entries before the region were already covered by earlier nodes.
+        entry_offset = index_offset - index_start
+        for leaf_count, data, start, size, *_ in index:
+            if entry_offset >= index_offset and size > 0:
+                yield entry_offset, leaf_count, data, start, size
+            entry_offset += size
+    def _first_time(self, entry):
+        # the capture time of the first chunk under an entry, descending its leftmost edge
+        entry_offset, leaf_count, data, start, size = entry
+        while leaf_count > 0:
+            entry_offset, leaf_count, data, start, size = next(self._region_entries(self.index_node(data), entry_offset, start))
+        times = data.get('capture', {}).get('time')
+        if not times:
+            raise ValueError('stream has no capture times to seek by')
+        return times[0]
+    def has_times(self):
+        # streams from multicapture.py record no per-chunk times to seek by
+        return not len(self) or bool(self.leaf_at(0)[2].get('capture', {}).get('time'))
+    def leaf_at_time(self, time):
+        # binary searches each node on the first time under its entries, down to the leaf
+        # holding the last chunk captured at or before time. returns the same as leaf_at.
+        if not self.has_times():
+            raise ValueError('stream has no capture times to seek by')
+        index, index_offset, index_start = self.tail, 0, 0
+        while True:
+            entries = list(self._region_entries(index, index_offset, index_start))
+            low, high = 0, len(entries)
+            while high - low > 1:
+                middle = (low + high) // 2
+                if self._first_time(entries[middle]) <= time:
+                    low = middle
+                else:
+                    high = middle
+            entry_offset, leaf_count, data, start, size = entries[low]
+            if leaf_count == 0:
+                return entry_offset, size, data
+            index, index_offset, index_start = self.index_node(data), entry_offset, start
+    def iterate_time(self, start = None, end = None):
+        # yields (time, header, stream, length) of capture chunks from the one in progress
+        # at start, through the last begun by end, fetching only the leaves they are in
+        if start is None and not self.has_times():
+            raise ValueError('stream has no capture times to seek by')
+        offset, size, data = self.leaf_at_time(start) if start is not None else self.leaf_at(0)
+        times = data['capture']['time']
+        skip = max(bisect.bisect_right(times, start) - 1, 0) if start is not None else 0
+        yield from self._iterate_leaves(offset, size, data, skip, end)
+    def iterate_from(self, offset):
+        # yields the same as iterate_time, from the leaf at offset to the end, with None times for
+        # streams that record none. appended leaves start where the stream used to end, so a
+        # follower fetches only them.
+        if offset < len(self):
+            yield from self._iterate_leaves(*self.leaf_at(offset), 0, None)
+    def _iterate_leaves(self, offset, size, data, skip, end):
+        with OrderedPipeline(self.prefetch, 'prefetch') as prefetcher:
+            while True:
+                # multicapture.py records no per-chunk times, and its chunks yield None
+                times = data['capture'].get('time') or [None for ditem in data['capture']['ditem']]
+                for time, ditem in zip(times[skip:], data['capture']['ditem'][skip:]):
+                    if end is not None and time is not None and time > end:
+                        break
+                    prefetcher.submit(lambda time, ditem, block: (time, *self.dataitem(ditem, block)), time, ditem, data['min_block'])
+                    yield from prefetcher.completed()
+                else:
+                    offset += size
+                    if offset < len(self):
+                        offset, size, data = self.leaf_at(offset)
+                        skip = 0
+                        continue
+                break
+            yield from prefetcher.completed(wait=True)
+    def open(self):
+        # a seekable binary file over the capture channel
+        return StreamFile(self)
+    def _leaf_item(self, index, channel_name, time, ditem, refetch = False):
+        if type(ditem) is not dict:
+            header, stream, length = self.dataitem(ditem, index['min_block'], refetch)
+        else:
+            header, stream, length = (None, ditem, 1)
+        #assert length > 0
+        return index, channel_name, time, header, stream, length
     def fetch_block(self, block):
         if type(block) is str:
             block = self.peer.block2_hash(block)
@@ -141,21 +344,65 @@ class Stream:
             return block
         return Block.frombytes(block)
     def _txs2bundles(self, txs, label, unconfirmed=False):
+        def is_bundle(txid):
+            if unconfirmed:
+                tags = Transaction.frombytes(self.peer.unconfirmed_tx2(txid)).tags
+            else:
+                tags = self.peer.tx_tags(txid)
+            return any((ar.utils.b64dec_if_not_bytes(tag['name']) in (b'Bundle-Format', b'Bundle-Version') for tag in tags))
         bundles = []
-        with tqdm(txs, unit='tx', desc=label) as items:
-            for txid in items:
-                if unconfirmed:
-                    tags = Transaction.frombytes(self.peer.unconfirmed_tx2(txid)).tags
-                else:
-                    tags = self.peer.tx_tags(txid)
-                if any((ar.utils.b64dec_if_not_bytes(tag['name']) in (b'Bundle-Format', b'Bundle-Version') for tag in tags)):
+        # tags are fetched concurrently, and checked in block order
+        with tqdm(zip(txs, self.scan_pool.map(is_bundle, txs)), total=len(txs), unit='tx', desc=label) as items:
+            for txid, bundle in items:
+                if bundle:
                     bundles.append(txid)
         return bundles
+    def _block_bundles_future(self, height):
+        # scans a block in the background, once
+        with self.block_futures_lock:
+            future = self.block_futures.get(height)
+            if future is None:
+                future = self.block_pool.submit(self.block_bundles, height)
+                self.block_futures[height] = future
+            return future
+    def _bundle_header(self, bundle, mined):
+        # returns None if the bundle can't be read yet
+        header = self.cache.get('header', bundle) if self.cache is not None else None
+        if header is not None:
+            return ANS104BundleHeader(header)
+        try:
+            if mined:
+                stream = self.peer.stream(bundle)
+            else:
+                stream = self.peer.gateway_stream(bundle)
+        except ArweaveException as exc:
+            if mined:
+                logger.exception(f'peer did not provide {bundle}')
+            return None
+        try:
+            stream.__enter__()
+            header = ANS104BundleHeader.fromstream(stream)
+        except ArweaveNetworkException as exc:
+            stream.__exit__(None, None, None)
+            if exc.args[1] == 404:
+                if mined:
+                    logger.exception(f'peer did not provide chunks for {bundle}')
+                return None
+            raise
+        stream.__exit__(None, None, None)
+        if self.cache is not None and mined:
+            # mined bundles don't change
+            self.cache.put('header', bundle, header.length_by_id)
+        return header
     def _cache_block(self, block):
         block = self.fetch_block(block)
         bundles = self._txs2bundles(block.txs, f'Caching {block.height}')
-        self.bundle_cache[block.height] = bundles
-        self.height_cache[block.indep_hash] = block.height
+        with self.cache_lock:
+            self.bundle_cache[block.height] = bundles
+            self.height_cache[block.indep_hash] = block.height
+        if self.cache is not None:
+            self.cache.put('bundles', block.height, bundles)
+            self.cache.put('height', block.indep_hash, block.height)
         return block.height, bundles
     def block_bundles(self, block):
         if block is None:
@@ -163,40 +410,136 @@ class Stream:
             return self._txs2bundles(pending, f'{len(pending)} pending (central gateway)', unconfirmed = True)
         if type(block) is str:
             block = self.block_height(block)
-        bundles = self.bundle_cache.get(block)
+        with self.cache_lock:
+            bundles = self.bundle_cache.get(block)
+        if bundles is None and self.cache is not None:
+            bundles = self.cache.get('bundles', block)
+            if bundles is not None:
+                with self.cache_lock:
+                    self.bundle_cache[block] = bundles
         if bundles is None:
             #current_height = self.peer.height()
             #if block > current_height:
             #     raise KeyError(f'block {block} does not exist yet')
-            self._cache_block(block)
-            bundles = self.bundle_cache[block]
+            height, bundles = self._cache_block(block)
         return bundles
     def recache_blocks_from(self, min_height):
-        extra_heights = [height for height in self.bundle_cache if height >= min_height]
-        for height in extra_heights:
-            del self.bundle_cache[height]
+        with self.cache_lock:
+            extra_heights = [height for height in self.bundle_cache if height >= min_height]
+            for height in extra_heights:
+                del self.bundle_cache[height]
+        with self.block_futures_lock:
+            for height in [height for height in self.block_futures if height >= min_height]:
+                del self.block_futures[height]
+        if self.cache is not None:
+            self.cache.discard_from('bundles', min_height)
     def block_height(self, block):
         if type(block) is list:
             for block in block:
                 if type(block) is int:
                     return block
-        height = self.height_cache.get(block)
+        with self.cache_lock:
+            height = self.height_cache.get(block)
+        if height is None and self.cache is not None:
+            height = self.cache.get('height', block)
+            if height is not None:
+                with self.cache_lock:
+                    self.height_cache[block] = height
         if height is None:
-            self._cache_block(block)
-            height = self.height_cache[block]
+            height, bundles = self._cache_block(block)
         return height
-    def dataitem(self, id, preceding_block):
+    def dataitem(self, id, preceding_block, refetch = False):
+        # refetch: skip streams already open on its bundle, e.g. after a digest mismatch
+        bundle, start, end = self.locate(id, preceding_block)
+        for attempt in range(2):
+            if refetch or attempt > 0:
+                self._drop_streams(bundle)
+            header, data = self.fetch(bundle, start, end)
+            if not self.verify or self._signed(id, header, data):
+                return header, io.BytesIO(data), len(data)
+            logger.warning(f'{id} failed its signature check')
+        raise IntegrityError('dataitem failed its signature check', id)
+    @staticmethod
+    def _signed(id, header, data):
+        # the signature covers the tags and data, and the id is the hash of the signature
+        if header.id != id:
+            return False
+        signer = header.signer
+        return signer.verify(signer.public_key(header.raw_owner), DataItem(header=header, data=data).get_raw_signature_data(), header.raw_signature)
+    def fetch(self, bundle, start, end):
+        # reads one located dataitem. streams aren't shared between threads, so many can be fetched at once.
+        stream = self._take_stream(bundle)
+        if stream is None:
+            # not yet mined
+            with self.peer.gateway_stream(bundle, range=(start, end)) as stream:
+                header = ANS104DataItemHeader.fromstream(stream)
+                data = stream.read(end - start - header.get_len_bytes())
+            return header, data
+        try:
+            stream.seek(start)
+            header = ANS104DataItemHeader.fromstream(stream)
+            data = stream.read(end - start - header.get_len_bytes())
+        except:
+            stream.close()
+            raise
+        self._give_stream(bundle, stream)
+        return header, data
+    def _take_stream(self, bundle):
+        # an idle open stream of a mined bundle, or a new one. neighbouring dataitems
+        # then share the chunk it holds, and its offset lookup.
+        with self.bundle_streams_lock:
+            idle = self.bundle_streams.get(bundle)
+            if idle is not None:
+                self.bundle_streams.move_to_end(bundle)
+                if len(idle):
+                    return idle.pop()
+        try:
+            return self.peer.peer_stream(bundle)
+        except ArweaveException:
+            return None
+    def _give_stream(self, bundle, stream):
+        with self.bundle_streams_lock:
+            self.bundle_streams.setdefault(bundle, []).append(stream)
+            self.bundle_streams.move_to_end(bundle)
+            while len(self.bundle_streams) > self.open_bundles:
+                old_bundle, old_streams = self.bundle_streams.popitem(last=False)
+                for old_stream in old_streams:
+                    old_stream.close()
+    def _drop_streams(self, bundle):
+        with self.bundle_streams_lock:
+            streams = self.bundle_streams.pop(bundle, [])
+        for stream in streams:
+            stream.close()
+    def _index_bundle(self, bundle, header):
+        # records where every dataitem in a parsed bundle header is
+        offset = header.get_len_bytes()
+        with self.locations_lock:
+            for id, length in header.length_by_id.items():
+                self.locations[id] = (bundle, offset, offset + length)
+                offset += length
+            while len(self.locations) > self.location_count:
+                self.locations.popitem(last=False)
+    def _location(self, id):
+        with self.locations_lock:
+            location = self.locations.get(id)
+            if location is not None:
+                self.locations.move_to_end(id)
+                return location
+        if self.cache is not None:
+            location = self.cache.get('location', id)
+            if location is not None:
+                return tuple(location)
+        return None
+    def locate(self, id, preceding_block):
+        # finds the bundle and range holding a dataitem, walking the chain from preceding_block
+        with self.lock:
+            return self._locate(id, preceding_block)
+    def _locate(self, id, preceding_block):
         while True:
-            try:
-                header, stream = self.cached_bundle
-                start, end = header.get_range(id)
-                try:
-                    stream.seek(start)
-                except:
-                    stream.read(start - stream.tell())
-                return ANS104DataItemHeader.fromstream(stream), stream, end - stream.tell()
-            except:
-                pass
+            # one lookup for anything in a bundle already parsed
+            location = self._location(id)
+            if location is not None:
+                return location
             try:
                 bundles_to_retry = set()
                 bundles_tried = set()
@@ -205,44 +548,35 @@ class Stream:
                 current_height = self.peer.height()
                 height = min(current_height - 1, preceding_height + 1)
                 while True:
-                    for bundle in (*self.block_bundles(height if height <= current_height else None), *bundles_to_retry):
-                        if bundle in bundles_tried:
-                            continue
+                    if height <= current_height:
+                        # the next few blocks are scanned while this one is searched
+                        for ahead in range(height + 1, min(height + self.scan_heights, current_height) + 1):
+                            self._block_bundles_future(ahead)
                         try:
-                            if height <= current_height:
-                                stream = self.peer.stream(bundle)
-                            else:
-                                assert height == current_height + 1
-                                stream = self.peer.gateway_stream(bundle)
-                        except ArweaveException as exc:
-                            if height <= current_height:
-                                logger.exception(f'peer did not provide {bundle}')
+                            block_bundles = self._block_bundles_future(height).result()
+                        finally:
+                            with self.block_futures_lock:
+                                self.block_futures.pop(height, None)
+                    else:
+                        assert height == current_height + 1
+                        block_bundles = self.block_bundles(None)
+                    bundles = [bundle for bundle in (*block_bundles, *bundles_to_retry) if bundle not in bundles_tried]
+                    # headers are read concurrently, and searched in block order
+                    mined = height <= current_height
+                    headers = self.scan_pool.map(lambda bundle: self._bundle_header(bundle, mined), bundles)
+                    for bundle, header in zip(bundles, headers):
+                        if header is None:
                             bundles_to_retry.add(bundle)
                             continue
-                        try:
-                            stream.__enter__()
-                            header = ANS104BundleHeader.fromstream(stream)
-                        except ArweaveNetworkException as exc:
-                            stream.__exit__(None, None)
-                            if exc.args[1] == 404:
-                                if height <= current_height:
-                                    logger.exception(f'peer did not provide chunks for {bundle}')
-                                bundles_to_retry.add(bundle)
-                                continue
-                            raise
+                        self._index_bundle(bundle, header)
                         if id in header.length_by_id:
                             if height > self.tail_height:
                                 self.tail_height = height
-                            if self.cached_bundle is not None:
-                                old_header, old_stream = self.cached_bundle
-                                old_stream.__exit__(None, None)
-                            self.cached_bundle = header, stream
-                            start, end = header.get_range(id)
-                            try:
-                                stream.seek(start)
-                            except:
-                                stream.read(start - stream.tell())
-                            return ANS104DataItemHeader.fromstream(stream), stream, end - stream.tell()
+                            location = self._location(id)
+                            if self.cache is not None and mined:
+                                # later runs resume without walking the chain
+                                self.cache.put('location', id, location)
+                            return location
                         else:
                             # here is where a new bundle header has been parsed
                             # if height > current_height, there could be a new tip in the bundle
@@ -263,7 +597,6 @@ class Stream:
                             #            logger.warning('found another ditem with this owner!')
                             #            break
                             #        offset += length
-                            stream.__exit__(None, None, None)
                             bundles_to_retry.discard(bundle)
                             if height > current_height:
                                 assert height == current_height + 1
@@ -273,7 +606,9 @@ class Stream:
                     
                     if height <= current_height:
                         height += 1
-                    current_height = self.peer.height()
+                    if height >= current_height:
+                        # blocks below the tip are already known to exist
+                        current_height = self.peer.height()
                     if height > current_height + 1:
                         height = current_height - 1
                         self.recache_blocks_from(current_height)
@@ -285,19 +620,297 @@ class Stream:
         header, stream, length = self.dataitem(id, preceding_block)
         return json.loads(stream.read(length))
 
-for fn in sys.argv[1:]:
-    with open(fn) as fh:
-        stream = Stream(json.load(fh), Peer())#'http://gateway-4.arweave.net:1984'))
-    for metadata, channel_name, time, header, stream, length in stream.iterate():
-        if time is not None:
-            time = datetime.datetime.fromtimestamp(time).isoformat()
-            sys.stderr.write('channel data: ' + channel_name + ': ' + str(length) + ' @ ' + time + '\n')#repr(stream.read(length))+'\n')
+class StreamFile(io.RawIOBase):
+    def __init__(self, stream):
+        '''
+        Random access to the capture channel of a Stream. Seeking descends the
+        index to the covering leaf, and only the dataitems read are fetched,
+        the next few ahead of time.
+        '''
+        self.stream = stream
+        self.size = len(stream)
+        self.offset = 0
+        self.leaf = None # (stream offset, size, data) of the current leaf
+        self.ditems = [] # (stream offset, data) of its dataitems fetched so far
+        self.futures = {}
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=stream.prefetch, thread_name_prefix='read')
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def tell(self):
+        return self.offset
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.offset
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.offset = max(0, offset)
+        return self.offset
+    def close(self):
+        if not self.closed:
+            for future in self.futures.values():
+                future.cancel()
+            self.pool.shutdown(wait=False)
+        super().close()
+    def _fetch(self, idx):
+        # a capture dataitem of the current leaf, starting the next few as well
+        leaf_offset, leaf_size, data = self.leaf
+        ditems = data['capture']['ditem']
+        for ahead in range(idx, min(idx + self.stream.prefetch, len(ditems))):
+            if ahead not in self.futures:
+                self.futures[ahead] = self.pool.submit(self.stream.dataitem, ditems[ahead], data['min_block'])
+        header, stream, length = self.futures.pop(idx).result()
+        return stream.read(length)
+    def _load(self):
+        # the dataitem covering self.offset, fetching up to it from the start of its leaf
+        leaf_offset, leaf_size, data = self.leaf if self.leaf is not None else (0, 0, None)
+        if not leaf_offset <= self.offset < leaf_offset + leaf_size:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+            self.leaf = self.stream.leaf_at(self.offset)
+            self.ditems = []
+            leaf_offset, leaf_size, data = self.leaf
+        for ditem_offset, ditem_data in self.ditems:
+            if ditem_offset <= self.offset < ditem_offset + len(ditem_data):
+                return ditem_offset, ditem_data
+        if not len(self.ditems):
+            self.ditems.append((leaf_offset, self._fetch(0)))
+        while self.ditems[-1][0] + len(self.ditems[-1][1]) <= self.offset:
+            ditem_offset, ditem_data = self.ditems[-1]
+            self.ditems.append((ditem_offset + len(ditem_data), self._fetch(len(self.ditems))))
+        return self.ditems[-1]
+    def readinto(self, b):
+        if self.offset >= self.size:
+            return 0
+        ditem_offset, ditem_data = self._load()
+        suboffset = self.offset - ditem_offset
+        bytecount = min(len(b), len(ditem_data) - suboffset)
+        b[:bytecount] = memoryview(ditem_data)[suboffset:suboffset + bytecount]
+        self.offset += bytecount
+        return bytecount
+
+class ChannelWriter(threading.Thread):
+    def __init__(self, path, root = None, backlog = 64):
+        '''
+        Writes the chunks of one channel on its own thread, so that channels are
+        written concurrently and a slow file or pipe holds back the others only
+        once backlog chunks of it are queued.
+
+        path: file or fifo to write to, or with root, the directory to write files under
+        root: for a channel from a multicapture.py PathWatcher, the path it watched.
+              each file is a chunk of its nul-terminated path, then chunks of a zstd
+              frame of its content, which are decompressed as they come.
+        backlog: chunks queued before put() blocks
+        '''
+        super().__init__(name=f'export {path}')
+        self.path = path
+        self.root = root
+        self.queue = queue.Queue(backlog)
+        self.file = None
+        self.next_path = None # path of the next file, opened once its frame begins
+        self.decompressor = None
+        self.exception = None
+        self.start()
+    def put(self, chunk):
+        # bytes, or a dict from a channel of json records
+        self.queue.put(chunk)
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+    def run(self):
+        try:
+            if self.root is None:
+                self.file = open(self.path, 'wb')
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                self.write(chunk)
+        except Exception as exc:
+            self.exception = exc
+            # iteration goes on for the other channels
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if self.file is not None:
+                self.file.close()
+    def write(self, chunk):
+        if type(chunk) is dict:
+            self.file.write(json.dumps(chunk).encode() + b'\n')
+        elif self.root is None:
+            self.file.write(chunk)
+        elif self.decompressor is None or self.decompressor.eof or (self.next_path is not None and not chunk.startswith(b'\x28\xb5\x2f\xfd') and chunk.endswith(b'\0')):
+            # the path of the next file. a path straight after another is a file that couldn't be read.
+            self.next_path = chunk[:-1].decode(errors='surrogateescape')
+            self.decompressor = zstd.ZstdDecompressor().decompressobj()
         else:
-            sys.stderr.write('channel data: ' + channel_name + ': ' + str(length) + '\n')#repr(stream.read(length))+'\n')
-        if channel_name == 'capture':
-            sys.stdout.buffer.write(stream.read(length))
-        #else:
+            if self.next_path is not None:
+                self.open_file(self.next_path)
+                self.next_path = None
+            self.file.write(self.decompressor.decompress(chunk))
+    def open_file(self, name):
+        if self.file is not None:
+            self.file.close()
+        name = os.path.relpath(name, self.root)
+        if name.startswith(os.pardir + os.sep):
+            name = os.path.basename(name)
+        name = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        self.file = open(name, 'wb')
+
+def export(stream, dir):
+    # writes every channel to its own file under dir in one pass over the stream
+    os.makedirs(dir, exist_ok=True)
+    writers = {}
+    try:
+        for metadata, channel_name, time, header, data, length in stream.iterate():
+            writer = writers.get(channel_name)
+            if writer is None:
+                # multicapture.py names PathWatcher channels by the absolute path they watch
+                name = channel_name.strip(os.sep).replace(os.sep, '_') or '_'
+                writer = ChannelWriter(os.path.join(dir, name), root = channel_name if channel_name.startswith(os.sep) else None)
+                writers[channel_name] = writer
+            writer.put(data if type(data) is dict else data.read(length))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+def write_range(file, length = None):
+    # copies from a StreamFile's position to stdout
+    buffer = memoryview(bytearray(1024*1024))
+    while length is None or length > 0:
+        bytecount = file.readinto(buffer if length is None else buffer[:length])
+        if not bytecount:
+            break
+        sys.stdout.buffer.write(buffer[:bytecount])
+        if length is not None:
+            length -= bytecount
+
+def parse_time(text):
+    # seconds since the epoch, an iso datetime, or an iso time of day today
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        return datetime.datetime.combine(datetime.date.today(), datetime.time.fromisoformat(text)).timestamp()
+
+def load_locator(fn):
+    # a locator file holds one tail, or one per line when a capture's output is appended to it
     with open(fn) as fh:
-        if stream.update_tail(json.load(fh)):
-            # new content available in file
-            pass
+        text = fh.read()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        for line in reversed(text.splitlines()):
+            try:
+                return json.loads(line)
+            except json.JSONDecodeError:
+                pass
+    raise ValueError('no locator in file', fn)
+
+def follow(stream, fn, poll):
+    # writes what is appended to the capture channel each time the locator file changes,
+    # rereading it every poll seconds in case a change is missed
+    changed = threading.Event()
+    path = os.path.abspath(fn)
+    class Handler(watchdog.events.FileSystemEventHandler):
+        def on_any_event(self, event):
+            if path in (event.src_path, getattr(event, 'dest_path', None)):
+                changed.set()
+    observer = watchdog.observers.Observer()
+    observer.schedule(Handler(), os.path.dirname(path))
+    observer.start()
+    try:
+        while True:
+            offset = len(stream)
+            changed.wait(poll)
+            changed.clear()
+            try:
+                metadata = load_locator(fn)
+            except (OSError, ValueError):
+                # partly written
+                continue
+            if stream.update_tail(metadata):
+                for time, header, data, length in stream.iterate_from(offset):
+                    if time is not None:
+                        sys.stderr.write('capture: ' + str(length) + ' @ ' + datetime.datetime.fromtimestamp(time).isoformat() + '\n')
+                    else:
+                        sys.stderr.write('capture: ' + str(length) + '\n')
+                    sys.stdout.buffer.write(data.read(length))
+                sys.stdout.buffer.flush()
+    finally:
+        observer.stop()
+        observer.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='download streams stored by capture_stdin.py, multicapture.py or shuffle_hdc.py')
+    parser.add_argument('locators', nargs='+', help='locator files written alongside a capture')
+    parser.add_argument('--offset', type=int, help='byte of the capture channel to start at, seeking instead of replaying from the start')
+    parser.add_argument('--length', type=int, help='bytes of the capture channel to write')
+    parser.add_argument('--from', dest='start', type=parse_time, help='capture time to start at, as epoch seconds or an iso datetime or time of day')
+    parser.add_argument('--to', dest='end', type=parse_time, help='capture time to end at, in the same forms as --from')
+    parser.add_argument('--prefetch', type=int, default=16, help='dataitems to fetch concurrently')
+    parser.add_argument('--verify-only', action='store_true', help='check every signature and digest of the streams without writing them')
+    parser.add_argument('--no-verify', dest='verify', action='store_false', help='skip signature and digest checks')
+    parser.add_argument('--follow', action='store_true', help='keep writing what is appended to the stream as the locator file is updated')
+    parser.add_argument('--poll', type=float, default=10, help='seconds between rereading a followed locator file if no change is noticed')
+    parser.add_argument('--export', metavar='DIR', help='write every channel to its own file in DIR, unpacking the files of watched paths; an existing fifo there is written to as well')
+    args = parser.parse_args()
+    if args.export is not None and (args.offset is not None or args.length is not None or args.start is not None or args.end is not None or args.verify_only or args.follow):
+        parser.error('--export takes no --offset, --length, --from, --to, --verify-only or --follow')
+    if args.follow and (len(args.locators) > 1 or args.length is not None or args.end is not None or args.verify_only):
+        parser.error('--follow takes one locator, and no --length, --to or --verify-only')
+    if args.verify_only and not args.verify:
+        parser.error('--verify-only needs verification')
+
+    cache = BlockCache(cache_path, cache_size) if cache_path else None
+    for fn in args.locators:
+        stream = Stream(load_locator(fn), Peer(), prefetch = args.prefetch, cache = cache, verify = args.verify)#'http://gateway-4.arweave.net:1984'))
+        if args.verify_only:
+            chunk_ct, chunk_size, leaf_ct, leaf = 0, 0, 0, None
+            try:
+                for metadata, channel_name, time, header, data, length in stream.iterate():
+                    if metadata is not leaf:
+                        leaf = metadata
+                        leaf_ct += 1
+                    if channel_name == 'capture':
+                        chunk_ct += 1
+                        chunk_size += length
+            except IntegrityError as exc:
+                sys.exit(f'{fn}: {exc.args[0]}: {exc.args[1]}')
+            sys.stderr.write(f'{fn}: verified {chunk_ct} chunks ({chunk_size} bytes) in {leaf_ct} leaves\n')
+        elif args.export is not None:
+            export(stream, args.export)
+        elif args.start is not None or args.end is not None:
+            if not stream.has_times():
+                sys.exit(f'{fn}: stream has no capture times; --from and --to need one from capture_stdin.py or shuffle_hdc.py')
+            for time, header, data, length in stream.iterate_time(args.start, args.end):
+                sys.stderr.write('capture: ' + str(length) + ' @ ' + datetime.datetime.fromtimestamp(time).isoformat() + '\n')
+                sys.stdout.buffer.write(data.read(length))
+        elif args.offset is not None or args.length is not None:
+            with stream.open() as file:
+                file.seek(args.offset or 0)
+                write_range(file, args.length)
+        else:
+            for metadata, channel_name, time, header, data, length in stream.iterate():
+                if time is not None:
+                    time = datetime.datetime.fromtimestamp(time).isoformat()
+                    sys.stderr.write('channel data: ' + channel_name + ': ' + str(length) + ' @ ' + time + '\n')#repr(data.read(length))+'\n')
+                else:
+                    sys.stderr.write('channel data: ' + channel_name + ': ' + str(length) + '\n')#repr(data.read(length))+'\n')
+                if channel_name == 'capture':
+                    sys.stdout.buffer.write(data.read(length))
+                #else:
+        if args.follow:
+            sys.stdout.buffer.flush()
+            follow(stream, fn, args.poll)
+
+if __name__ == '__main__':
+    main()
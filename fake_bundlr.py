@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# a local stand-in for a bundlr node and the gateway block endpoints, for testing
+# and benchmarking uploads without a network or funds.
+# usage: fake_bundlr.py [port] [latency] [error_rate] [bandwidth]
+
+import hashlib, http.server, io, json, random, socketserver, sys, threading, time
+import ar, ar.utils
+
+class FakeBundlr(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    def __init__(self, port=0, latency=0, error_rate=0, bandwidth=None, host='127.0.0.1'):
+        '''
+        port: port to listen on, 0 for any free port
+        latency: seconds to wait before responding to each upload
+        error_rate: fraction of uploads to fail with a 503
+        bandwidth: upload bytes per second shared by all connections, or None for unlimited
+        '''
+        super().__init__((host, port), self.Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.link_free_time = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.items = {}
+        self.stats = dict(requests = 0, errors = 0, bytes = 0, connections = 0)
+        self.thread = None
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}'
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *params):
+        self.stop()
+    def count(self, **counts):
+        with self.lock:
+            for key, val in counts.items():
+                self.stats[key] += val
+    def transfer(self, length):
+        # waits for length bytes to cross a link shared with every other upload
+        if not self.bandwidth:
+            return
+        with self.lock:
+            start = max(time.time(), self.link_free_time)
+            self.link_free_time = start + length / self.bandwidth
+            end = self.link_free_time
+        time.sleep(max(end - time.time(), 0))
+    @property
+    def block(self):
+        # a block every two minutes since the server started
+        height = int((time.time() - self.started) // 120)
+        return dict(
+            height = height,
+            indep_hash = ar.utils.b64enc(hashlib.sha384(str(height).encode()).digest()),
+            timestamp = int(self.started) + height * 120,
+        )
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive
+        def setup(self):
+            super().setup()
+            self.server.count(connections = 1)
+        def log_message(self, *params):
+            pass
+        def respond(self, code, content):
+            content = json.dumps(content).encode() if type(content) is not bytes else content
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            # one write per response, so delayed acks don't stall keep-alive clients
+            self._headers_buffer.append(b'\r\n' + content)
+            self.flush_headers()
+        def do_GET(self):
+            if self.path == '/info':
+                self.respond(200, dict(version = '0.0.0', addresses = {}, gateway = 'localhost', height = self.server.block['height']))
+            elif self.path in ('/block/current', '/current_block'):
+                self.respond(200, self.server.block)
+            else:
+                self.respond(404, b'Not Found')
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            server = self.server
+            server.count(requests = 1, bytes = len(body))
+            server.transfer(len(body))
+            if server.latency:
+                time.sleep(server.latency)
+            if not self.path.startswith('/tx/'):
+                return self.respond(404, b'Not Found')
+            if random.random() < server.error_rate:
+                server.count(errors = 1)
+                return self.respond(503, b'Service Unavailable')
+            try:
+                id = ar.ANS104DataItemHeader.fromstream(io.BytesIO(body)).id
+            except Exception:
+                # unsigned benchmark payloads
+                id = ar.utils.b64enc(hashlib.sha256(body).digest())
+            with server.lock:
+                if id in server.items:
+                    return self.respond(201, b'OK')
+                server.items[id] = len(body)
+            self.respond(200, dict(id = id, timestamp = int(time.time() * 1000)))
+
+if __name__ == '__main__':
+    defaults = [0, 0, 0, 0]
+    port, latency, error_rate, bandwidth = [*sys.argv[1:5], *defaults[len(sys.argv[1:5]):]]
+    with FakeBundlr(int(port), float(latency), float(error_rate), float(bandwidth) or None) as server:
+        print(f'Serving on {server.url} ...', flush=True)
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+        print(json.dumps(server.stats), flush=True)
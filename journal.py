@@ -0,0 +1,57 @@
+import json, os, threading
+
+class Journal:
+    def __init__(self, path):
+        '''
+        An append-only file of json records, written ahead of acknowledging
+        uploads so that a stream can be resumed after a crash.
+
+        path: journal file; records left there by a previous run are loaded
+              into self.records. a final line torn by a crash is discarded.
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = []
+        try:
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        self.records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        self.file = None
+        self.rewrite(self.records)
+    @property
+    def ended(self):
+        # whether the previous run finished its stream cleanly
+        return len(self.records) and self.records[-1]['type'] == 'end'
+    def append(self, record, sync=True):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+    def rewrite(self, records):
+        # atomically replaces the journal, e.g. to compact it
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as fh:
+                for record in records:
+                    fh.write(json.dumps(record) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(self.path + '.tmp', self.path)
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.path, 'a')
+            self.records = list(records)
+    def close(self, ended=False):
+        if ended:
+            self.append(dict(type = 'end'))
+        with self.lock:
+            self.file.close()
@@ -8,6 +8,12 @@ import json
 from ar import Peer, Wallet, DataItem, ArweaveNetworkException, logger
 from ar.utils import create_tag
 from bundlr import Node
+from bundlr.node import DEFAULT_API_URL
+from async_sender import AsyncSender
+from signing import SigningPool
+from retry import RetryPolicy
+from journal import Journal
+from channel import Channel
 from flat_tree import flat_tree
 import watchdog.observers, watchdog.events
 import zstandard as zstd
@@ -21,19 +27,33 @@ except:
     print('Generating an identity ...')
     wallet = Wallet.generate(jwk_file='identity.json')
 
-node = Node(timeout = 0.5) # 0.25 i was getting timeout loops on domestic wifi
+gateway_url = os.environ.get('GATEWAY_URL', 'https://arweave.net') # benchmark.py points these at fake_bundlr.py
+bundlr_url = os.environ.get('BUNDLR_URL', DEFAULT_API_URL)
+async_connections = None # a number of keep-alive sockets to post from an asyncio loop instead of per-thread requests
+node = Node(bundlr_url, timeout = 0.5) # 0.25 i was getting timeout loops on domestic wifi
+if async_connections:
+    node = AsyncSender(node.api_url, async_connections, timeout = node.timeout)
+signing_workers = None # a number of processes to sign DataItems in, so Storer threads don't serialize on the GIL
+signer = SigningPool('identity.json', signing_workers) if signing_workers else None
+# backs off instead of spinning on the short node timeout, and pauses all storers while the node is down
+retry_policy = RetryPolicy(retry_on=ArweaveNetworkException)
+journal_path = os.path.basename(__file__).rsplit('.',1)[0]+'.journal' # uploads and index appends, to continue the stream after a crash; None disables
+journal = None # opened when run, so importing this has no side effects
 def send(data, **tags):
-    di = DataItem(data = data)
-    di.header.tags = [
+    tags = [
         create_tag(key, val, True)
         for key, val in tags.items()
     ]
-    di.sign(wallet.rsa)
-    while True:
+    if signer is not None:
+        di = signer.sign(data, tags)
+    else:
+        di = DataItem(data = data)
+        di.header.tags = tags
+        di.sign(wallet.rsa)
+    def attempt():
         #print('send loop')
         try:
-            result = node.send_tx(di.tobytes())
-            break
+            return node.send_tx(di.tobytes())
         except ArweaveNetworkException as exc:
             text, code, exc2, response = exc.args
             if code == 201: # already received
@@ -43,22 +63,16 @@ def send(data, **tags):
                 logger.exception(text)
             else: # read timeout
                 print('send timeout, retry')
-    return result
+            raise
+    return retry_policy.call(attempt)
 
 running = True
 running_lock = threading.Lock()
 running_condition = threading.Condition(running_lock)
 
-class Data:
-    data = deque()
-    lock = threading.Lock()
-    condition = threading.Condition(lock)
-    @classmethod
-    def append_needs_lk(cls, type, item):
-        cls.data.append((type, item))
-    @classmethod
-    def extend_needs_lk(cls, type, items):
-        cls.data.extend(((type, item) for item in items))
+channel_capacity = 256 # reads each source may queue before it waits for the storers
+# sources are served in turn, so a chatty one like journalctl can't starve video
+inputs = Channel(channel_capacity)
 
 class BinaryProcessStream(threading.Thread):
     def __init__(self, name, proc, *params, constant_output = False, **kwparams):
@@ -75,33 +89,25 @@ class BinaryProcessStream(threading.Thread):
             print(f'{self.name.title()} failed.')
             return
         capture = capture_proc.stdout
-        raws = []
         while running:
             #print(f'{self.name} read loop')
             raw = capture.read1(100000) if not self.constant_output else capture.read(100000)
-            raws.append(raw)
-            if Data.lock.acquire(blocking=False):
-                Data.extend_needs_lk(self.name, raws)
-                Data.condition.notify()
-                Data.lock.release()
-                raws.clear()
-                #print(len(Data.data), 'queued while running from', self.name)
+            if not len(raw):
+                break
+            # blocks while this source's queue is full
+            inputs.put(self.name, raw)
+            #print(len(inputs), 'queued while running from', self.name)
         print(f'Finishing {self.name}ing')
         capture_proc.terminate()
         while True:
             #print(f'{self.name} read loop')
             #print(f'{self.name}: reading 1')
             raw = capture.read(100000)
-            #print(f'{self.name} read: {len(raw)} len(raws)={len(raws)} proc.poll={capture_proc.poll()}')
+            #print(f'{self.name} read: {len(raw)} proc.poll={capture_proc.poll()}')
             if len(raw) > 0:
-                raws.append(raw)
-            if len(raws):
-                with Data.lock:
-                    Data.extend_needs_lk(self.name, raws)
-                    Data.condition.notify()
-                raws.clear()
-                print(f'Finishing {self.name}', len(Data.data))
-                    #if len(Data.data[-1]) < 100000:
+                inputs.put(self.name, raw)
+                print(f'Finishing {self.name}', len(inputs))
+                    #if len(raw) < 100000:
                     #    break
             elif capture_proc.poll() is not None:
                 break
@@ -113,7 +119,6 @@ class Locationer(threading.Thread):
         self.start()
     def run(self):
         print('Locationing ...')
-        raws = []
         last = None
         while running:
             #print(f('location loop'))
@@ -127,12 +132,7 @@ class Locationer(threading.Thread):
                 raw = json.loads(stdout)
             except json.JSONDecodeError:
                 raw = {'stdout': stdout, 'stderr': stderr, 'returncode': location_proc.returncode}
-            raws.append(raw)
-            if Data.lock.acquire(blocking=False):
-                Data.extend_needs_lk('location', raws)
-                Data.condition.notify()
-                Data.lock.release()
-                raws.clear()
+            inputs.put('location', raw)
         print('Locationing finished')
 
 class FFMPEGer(BinaryProcessStream):
@@ -211,8 +211,7 @@ class PathWatcher(threading.Thread, watchdog.events.FileSystemEventHandler):
         assert self.cur_file is None
         if event.is_directory:
             return
-        with Data.lock:
-            Data.append_needs_lk(self.path, event.src_path.encode() + b'\0')
+        inputs.put(self.path, event.src_path.encode() + b'\0')
         self.just_closed = True
         try:
             self.cur_file = open(event.src_path, 'rb')
@@ -232,9 +231,7 @@ class PathWatcher(threading.Thread, watchdog.events.FileSystemEventHandler):
             if not in_chunk:
                 break
             for out_chunk in self.chunker.compress(in_chunk):
-                with Data.lock:
-                    Data.append_needs_lk(self.path, out_chunk)
-                    Data.condition.notify()
+                inputs.put(self.path, out_chunk)
         end = self.cur_file.tell() - start
         if end > start:
             self.just_closed = False
@@ -245,9 +242,7 @@ class PathWatcher(threading.Thread, watchdog.events.FileSystemEventHandler):
             self.cur_file = None
             print('finish')
             for out_chunk in self.chunker.finish():
-                with Data.lock:
-                    Data.append_needs_lk(self.path, out_chunk)
-                    Data.condition.notify()
+                inputs.put(self.path, out_chunk)
             self.chunker = None
     def on_created(self, event):
         #print('on_created', event.src_path)
@@ -303,38 +298,39 @@ class PathWatcher(threading.Thread, watchdog.events.FileSystemEventHandler):
             self.continue_file(None)
 
 class Storer(threading.Thread):
-    input_lock = threading.Lock()
     lock = threading.Lock()
     condition = threading.Condition(lock)
-    idx = 0
     output_idx = 0
     proc_idx = 0
     pool = set()
     output = defaultdict(deque)
-    #reader = BinaryProcessStream('capture', './capture')
-    readers = [
-        #BinaryProcessStream('capture', ('sh','-c','./capture | tee last_capture.log.bin'), constant_output = True),
-        BinaryProcessStream('capture', ('sh','-c','./capture'), constant_output = True),
-        Locationer(),
-        BinaryProcessStream('logcat', 'logcat', constant_output = True),
-        BinaryProcessStream('journalctl', ('journalctl', '--follow')),
-        *[
-            # ffmpeg -f v4l2 -i /dev/video1 -vaapi_device /dev/dri/renderD128 -vf 'format=nv12,hwupload' -codec:v hevc_vaapi -f matroska -v warning -
-            FFMPEGer(device, codec)
-            for device, codec in zip(FFMPEGer.video_devices(), FFMPEGer.default_codecs())
-        ]
-
-        #PathWatcher(os.path.abspath('.')),
-        #PathWatcher('/sdcard/Download'),
-    ]
+    readers = [] # sources the storers wait on; started by the main block
     exceptions = []
+    journaled = 0
     logs = {}
+    completed = {} # idx -> (channel, result) sent ahead of an earlier idx
+    latency = None # running average of seconds per send
+    min_workers = 2
+    max_workers = 16
+    idle_timeout = 10 # seconds a worker beyond min_workers waits for data before exiting
+    backlog_time = 2 # seconds of queued sends per worker that starts another, up to max_workers
     def __init__(self, *params, **kwparams):
+        # needs lock
         super().__init__(*params, **kwparams)
-        self.node = Node()
-        self.pending_input = deque()
-        self.pending_output = deque()
+        self.node = Node(bundlr_url)
+        self.proc_idx = Storer.proc_idx
+        self.logs[self.proc_idx] = []
+        Storer.proc_idx += 1
+        self.pool.add(self)
         self.start()
+    @classmethod
+    def scale(cls):
+        # needs lock
+        while len(cls.pool) < cls.min_workers:
+            cls()
+        if len(cls.pool) < cls.max_workers and cls.latency is not None:
+            if len(inputs) * cls.latency / len(cls.pool) > cls.backlog_time:
+                cls()
     def print(self, *params):
         return
         log = self.logs[self.proc_idx]
@@ -342,178 +338,201 @@ class Storer(threading.Thread):
             self.logs[self.proc_idx].append(params)
             print(*params)
     def run(self):
-        with self.input_lock:
-            self.proc_idx = Storer.proc_idx
-            self.logs[self.proc_idx] = []
-            Storer.proc_idx += 1
-            self.pool.add(self)
-            self.print(self.proc_idx, 'launching storing')
-        last_log_time = 0
-        last_log_time_2 = 0
-        while True:
-            #print(f'{self.proc_idx} loop')
-            try:
-                while len(self.pending_input):
-                    #print(f'{self.proc_idx} pending input loop')
-                    next_idx, next_type, next_data = self.pending_input[0]
-                    if type(next_data) is bytes:
-                        self.print(self.proc_idx, 'sending', next_idx)
-                        result = send(next_data)
-                        self.print(self.proc_idx, 'sent', idx)
-                        result['length'] = len(next_data)
-                    elif type(next_data) is dict:
-                        self.print(self.proc_idx, 'is dict')
-                        result = dict(id = next_data)
-                    else:
-                        raise AssertionError(f'unexpected content datatype {type(data)}: {channel}, {data}')
-                    self.pending_output.append((next_idx, next_type, result))
-                    self.pending_input.popleft()
-                while len(self.pending_output) and self.pending_output[0][0] == self.output_idx:
-                    #print(f'{self.proc_idx} pending output loop')
-                    next_idx, next_type, next_result = self.pending_output.popleft()
-                    self.print(self.proc_idx, 'taking storing lock with the next item')
+        self.print(self.proc_idx, 'launching storing')
+        last_work_time = time.time()
+        try:
+            while True:
+                # blocks until a source has data, instead of polling
+                next = inputs.get(timeout = 1)
+                if next is None:
                     with self.lock:
-                        #print(self.proc_idx, 'took storing lock')
-                        self.output[next_type].append(next_result)
-                        self.print(self.proc_idx, 'stored', Storer.output_idx, 'index queue size =', len(self.output))
-                        Storer.output_idx += 1
-                        self.condition.notify()
-                if len(self.pending_output) and self.pending_output[0][0] != self.output_idx:
-                    self.print(self.pending_output[0][0], 'not queuing, waiting for', self.output_idx)
-                    #print(self.logs)
-                #print(self.proc_idx, 'taking input_lock and Data.lock')
-                with self.input_lock, Data.lock:
-                    if time.time() > last_log_time + 1:
-                        last_log_time = time.time()
-                        self.print(self.proc_idx, 'took input_lock and Data.lock')
-                    #with self.reader.lock:
-                    #print(self.proc_idx, 'took reader_lock')
-                    if len(Data.data) == 0:
-                        if len(self.pending_input) or len(self.pending_output):# or (len(self.pool) == 1 and self.reader.is_alive()):
-                            continue
-                        if time.time() > last_log_time_2 + 1:
-                            last_log_time_2 = time.time()
-                            self.print('Stopping', self.proc_idx, 'len(self.pending) =', len(self.pending_input), len(self.pending_output), '; len(self.pool) =', len(self.pool), '; self.reader.is_alive() =', *(reader.is_alive() for reader in self.readers))
-                        raise StopIteration()
-                    channel, data = Data.data.popleft()
-                    if len(Data.data) > len(self.pool) * 2.25: #(len(self.pending_input) + len(self.pending_output)):
-                        self.print(self.proc_idx, 'spawning new; expected idx =', Storer.proc_idx)
-                        Storer()
-    
-                    idx = Storer.idx
-                    Storer.idx += 1
-                self.pending_input.append((idx, channel, data))
-                continue
-            except StopIteration:
-                self.print(self.proc_idx, 'finishing')
-                pass
-            except Exception as exc:
-                self.print(self.proc_idx, 'raised exception', type(exc))
-                with self.lock:
-                    self.exceptions.append(exc)
-            with self.input_lock:
-                if len(self.pool) == 1 and any((reader.is_alive() for reader in self.readers)) and not len(self.exceptions):
-                    #print(self.proc_idx, 'closed but reader still running, continuing anyway')
-                    with Data.lock:
-                        Data.condition.wait()
+                        if len(self.exceptions):
+                            break
+                        if not len(inputs) and not any((reader.is_alive() for reader in self.readers)):
+                            break
+                        if len(self.pool) > self.min_workers and time.time() > last_work_time + self.idle_timeout:
+                            # leaves the pool under the same lock, so concurrent idlers don't drop below min_workers
+                            self.pool.discard(self)
+                            break
                     continue
-                self.pool.remove(self)
+                idx, channel, data = next
+                with self.lock:
+                    Storer.scale()
+                start = time.time()
+                if type(data) is bytes:
+                    self.print(self.proc_idx, 'sending', idx)
+                    result = send(data)
+                    self.print(self.proc_idx, 'sent', idx)
+                    result['length'] = len(data)
+                elif type(data) is dict:
+                    self.print(self.proc_idx, 'is dict')
+                    result = dict(id = data)
+                else:
+                    raise AssertionError(f'unexpected content datatype {type(data)}: {channel}, {data}')
+                last_work_time = time.time()
+                with self.lock:
+                    if type(data) is bytes:
+                        latency = last_work_time - start
+                        Storer.latency = latency if Storer.latency is None else Storer.latency * 0.75 + latency * 0.25
+                    # results are indexed in the order their data was taken
+                    self.completed[idx] = (channel, result)
+                    while Storer.output_idx in self.completed:
+                        channel, result = self.completed.pop(Storer.output_idx)
+                        self.output[channel].append(result)
+                        if journal is not None:
+                            journal.append(dict(type = 'ditem', seq = Storer.journaled, channel = channel, result = result), sync = False)
+                            Storer.journaled += 1
+                        Storer.output_idx += 1
+                    self.print(self.proc_idx, 'stored through', Storer.output_idx, 'index queue size =', len(self.output))
+                    self.condition.notify_all()
+        except Exception as exc:
+            self.print(self.proc_idx, 'raised exception', type(exc))
+            with self.lock:
+                self.exceptions.append(exc)
+        finally:
+            with self.lock:
+                self.pool.discard(self)
                 self.print('storers remaining:', *(storer.proc_idx for storer in self.pool))
-                break
-Storer()
+                self.condition.notify_all()
+if __name__ == '__main__':
+    Storer.readers = [
+        #BinaryProcessStream('capture', ('sh','-c','./capture | tee last_capture.log.bin'), constant_output = True),
+        BinaryProcessStream('capture', ('sh','-c','./capture'), constant_output = True),
+        Locationer(),
+        BinaryProcessStream('logcat', 'logcat', constant_output = True),
+        BinaryProcessStream('journalctl', ('journalctl', '--follow')),
+        *[
+            # ffmpeg -f v4l2 -i /dev/video1 -vaapi_device /dev/dri/renderD128 -vf 'format=nv12,hwupload' -codec:v hevc_vaapi -f matroska -v warning -
+            FFMPEGer(device, codec)
+            for device, codec in zip(FFMPEGer.video_devices(), FFMPEGer.default_codecs())
+        ]
 
-first = None
-start_block = None
-prev = None
-peer = Peer(retries=9999999)
-offset = 0
-indices = flat_tree(3) #append_indices(3)
-prev_indices_snap = indices.snap()
-#index_values = indices
+        #PathWatcher(os.path.abspath('.')),
+        #PathWatcher('/sdcard/Download'),
+    ]
+    if journal_path:
+        journal = Journal(journal_path)
+        if journal.ended:
+            # the last stream finished cleanly; start a new one
+            journal.rewrite([])
+    resumed = None
+    if journal is not None:
+        # uploads that never made it into an index are indexed first
+        appends = [record for record in journal.records if record['type'] == 'append']
+        resumed = appends[-1] if len(appends) else None
+        Storer.journaled = resumed['ditems'] if resumed is not None else 0
+        ditems = [record for record in journal.records if record['type'] == 'ditem' and record['seq'] >= Storer.journaled]
+        for record in ditems:
+            Storer.output[record['channel']].append(record['result'])
+            Storer.journaled = record['seq'] + 1
+        journal.rewrite([*appends[-1:], *ditems])
+    with Storer.lock:
+        Storer.scale()
 
-current_block = peer.current_block()
-last_time = time.time()
+    first = None
+    start_block = None
+    prev = None
+    peer = Peer(gateway_url, retries=9999999)
+    offset = 0
+    indices = flat_tree(3) #append_indices(3)
+    prev_indices_snap = indices.snap()
+    #index_values = indices
 
-prev = None
+    current_block = peer.current_block()
+    last_time = time.time()
 
-data = None
-while True:
-    #print('indexing loop')
-    try:
-        #print('taking Storer lock')
-        if data is None:
-            with Storer.lock:
-                if len(Storer.exceptions):
-                    for exception in Storer.exceptions:
-                        raise exception
-                data = Storer.output.copy()
-                Storer.output.clear()
-                if not len(data):
-                    if not running and not len(Storer.pool) and not any((reader.is_alive() for reader in Storer.readers)):
-                        print('index thread stopping no output left')
-                        break
-                    print('no output to index, len(Storer.pool) =', len(Storer.pool), 'alive readers =', *(reader.is_alive() for reader in Storer.readers))
-                    Storer.condition.wait()
-                    data = None
-                    continue
-                print('indexing', len(data.get('capture', [])), 'captures, releasing Storer lock')
-            if time.time() > last_time + 60:
-                try:
-                    current_block = peer.current_block()
-                    last_time = time.time()
-                except Exception as e:
-                    logger.exception(e)
-        else:
-            pass
-            #print('data left over')
-        # this could be a dict of lengths
-        lengths = sum((capture['length'] for capture in data.get('capture', [])))
-        datas = {
-            type: dict(
-                ditem = [item['id'] for item in items],
-                length = sum((item.get('length', 1) for item in items))
+    prev = None
+
+    if resumed is not None:
+        indices = flat_tree(3, resumed['snap'])
+        prev_indices_snap = resumed['snap']
+        prev, first, start_block = resumed['prev'], resumed['first'], resumed['start_block']
+        print('resuming stream', first, 'from its journal')
+
+    data = None
+    while True:
+        #print('indexing loop')
+        try:
+            #print('taking Storer lock')
+            if data is None:
+                with Storer.lock:
+                    if len(Storer.exceptions):
+                        for exception in Storer.exceptions:
+                            raise exception
+                    data = Storer.output.copy()
+                    indexed_through = Storer.journaled
+                    Storer.output.clear()
+                    if not len(data):
+                        if not running and not len(Storer.pool) and not any((reader.is_alive() for reader in Storer.readers)):
+                            print('index thread stopping no output left')
+                            break
+                        print('no output to index, len(Storer.pool) =', len(Storer.pool), 'alive readers =', *(reader.is_alive() for reader in Storer.readers))
+                        Storer.condition.wait()
+                        data = None
+                        continue
+                    print('indexing', len(data.get('capture', [])), 'captures, releasing Storer lock')
+                if time.time() > last_time + 60:
+                    try:
+                        current_block = peer.current_block()
+                        last_time = time.time()
+                    except Exception as e:
+                        logger.exception(e)
+            else:
+                pass
+                #print('data left over')
+            # this could be a dict of lengths
+            lengths = sum((capture['length'] for capture in data.get('capture', [])))
+            datas = {
+                type: dict(
+                    ditem = [item['id'] for item in items],
+                    length = sum((item.get('length', 1) for item in items))
+                )
+                for type, items in data.items()
+            }
+            indices.append(
+                prev,
+                lengths,
+                dict(
+                    **datas,
+                    min_block = (current_block['height'], current_block['indep_hash']),
+                    api_block = max((0, *(item['block'] for items in data.values() for item in items if 'block' in item))) or None,
+                )
             )
-            for type, items in data.items()
-        }
-        indices.append(
-            prev,
-            lengths,
-            dict(
-                **datas,
+            indices_snap = indices.snap()
+            try:
+                result = send(json.dumps(indices_snap).encode())
+            except:
+                indices = flat_tree(3, prev_indices_snap)
+                raise
+            prev_indices_snap = indices_snap
+            prev = dict(
+                ditem = [result['id']],
                 min_block = (current_block['height'], current_block['indep_hash']),
-                api_block = max((0, *(item['block'] for items in data.values() for item in items if 'block' in item))) or None,
+                api_block = result['block'] if 'block' in result else None
             )
-        )
-        indices_snap = indices.snap()
-        try:
-            result = send(json.dumps(indices_snap).encode())
-        except:
-            indices = flat_tree(3, prev_indices_snap)
-            raise
-        prev_indices_snap = indices_snap
-        prev = dict(
-            ditem = [result['id']],
-            min_block = (current_block['height'], current_block['indep_hash']),
-            api_block = result['block'] if 'block' in result else None
-        )
-        data = None
-        if first is None:
-            first = result['id']
-            start_block = current_block['indep_hash']
+            data = None
+            if first is None:
+                first = result['id']
+                start_block = current_block['indep_hash']
+            if journal is not None:
+                # journaled before the locator is handed out
+                journal.append(dict(type = 'append', snap = indices_snap, prev = prev, first = first, start_block = start_block, ditems = indexed_through))
     
-        #eta = current_block['timestamp'] + (result['block'] - current_block['height']) * 60 * 2
-        #eta = datetime.fromtimestamp(eta)
-        #index_values = [value for leaf_count, value in indices]
-        with open(first, 'wt') as fh:
-            #json.dump(index_values[-1], fh)
-            json.dump(prev, fh)
-        #json.dump(index_values[-1], sys.stdout)
-        json.dump(prev, sys.stdout)
-        sys.stdout.write('\n')# + str(type(data)) + '\n')
-    except KeyboardInterrupt:
-        print('got a keyboard interrupt, setting running to false')
-        if not running:
-            break
-        running = False
-        with running_lock:
-            running_condition.notify_all()
+            #eta = current_block['timestamp'] + (result['block'] - current_block['height']) * 60 * 2
+            #eta = datetime.fromtimestamp(eta)
+            #index_values = [value for leaf_count, value in indices]
+            with open(first, 'wt') as fh:
+                #json.dump(index_values[-1], fh)
+                json.dump(prev, fh)
+            #json.dump(index_values[-1], sys.stdout)
+            json.dump(prev, sys.stdout)
+            sys.stdout.write('\n')# + str(type(data)) + '\n')
+        except KeyboardInterrupt:
+            print('got a keyboard interrupt, setting running to false')
+            if not running:
+                break
+            running = False
+            with running_lock:
+                running_condition.notify_all()
+    if journal is not None:
+        journal.close(ended = True)
@@ -0,0 +1,43 @@
+import concurrent.futures
+from collections import deque
+
+class OrderedPipeline:
+    def __init__(self, max_pending=2, name='pipeline'):
+        '''
+        Runs submitted calls on a long-lived bounded thread pool, and hands
+        their results back strictly in submission order.
+
+        max_pending: number of calls that may be running or unconsumed at once.
+                     once this many are pending, completed() waits on the oldest.
+        name: prefix for the pool's thread names
+        '''
+        self.max_pending = max_pending
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_pending, thread_name_prefix=name)
+        self.pending = deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *params):
+        self.shutdown()
+
+    def submit(self, fn, *params, **kwparams):
+        future = self.executor.submit(fn, *params, **kwparams)
+        self.pending.append(future)
+        return future
+
+    def completed(self, wait=False):
+        # yields results that are ready at the head of the queue.
+        # if too many are pending, waits for the oldest so the caller stays bounded.
+        # if wait is true, waits for everything.
+        while len(self.pending):
+            if not wait and len(self.pending) < self.max_pending and not self.pending[0].done():
+                break
+            future = self.pending.popleft()
+            yield future.result()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
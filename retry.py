@@ -0,0 +1,132 @@
+import math, random, threading, time
+
+class CircuitBreaker:
+    def __init__(self, threshold=8, reset_timeout=30):
+        '''
+        Pauses every caller sharing it while the remote end appears down.
+
+        threshold: consecutive failures, across all callers, that open the circuit
+        reset_timeout: seconds the circuit stays open before one caller is let
+                       through to probe. if the probe succeeds, everybody resumes.
+        '''
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.condition = threading.Condition()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opens = 0
+    @property
+    def open(self):
+        return self.opened_at is not None
+    def wait(self, deadline=None):
+        # blocks without spinning while open. returns False if deadline passes first.
+        with self.condition:
+            while self.opened_at is not None:
+                now = time.time()
+                probe_time = self.opened_at + self.reset_timeout
+                if now >= probe_time and not self.probing:
+                    self.probing = True
+                    return True
+                timeout = max(probe_time - now, 0) if not self.probing else self.reset_timeout
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    timeout = min(timeout, deadline - now)
+                self.condition.wait(timeout)
+            return True
+    def success(self):
+        with self.condition:
+            self.failures = 0
+            if self.opened_at is not None:
+                self.opened_at = None
+                self.probing = False
+                self.condition.notify_all()
+    def failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.probing:
+                # probe failed: stay open another period
+                self.probing = False
+                self.opened_at = time.time()
+                self.condition.notify_all()
+            elif self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = time.time()
+                self.opens += 1
+
+class RetryPolicy:
+    def __init__(self, initial=0.25, maximum=30, multiplier=2, deadline=None, breaker=None, retry_on=Exception):
+        '''
+        Retries calls with jittered exponential backoff. Share one between
+        senders so that they also share its circuit breaker and counters.
+
+        initial: upper bound in seconds of the first delay
+        maximum: upper bound in seconds of any delay
+        multiplier: growth of the bound after each failed attempt
+        deadline: seconds after which an item is given up on and its last
+                  exception raised, or None to retry forever
+        breaker: CircuitBreaker to share; one is made if not passed
+        retry_on: exception types to retry; others propagate immediately
+        '''
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.retry_on = retry_on
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.retry_time = 0
+        self.giveups = 0
+    @property
+    def stats(self):
+        with self.lock:
+            return dict(
+                retries = self.retries,
+                retry_time = self.retry_time,
+                giveups = self.giveups,
+                circuit_opens = self.breaker.opens,
+                circuit_open = self.breaker.open,
+            )
+    def delay(self, attempt):
+        # full jitter, so that a pool of senders doesn't retry in lockstep
+        if self.multiplier > 1:
+            # past where the bound reaches maximum the exponent only grows toward an overflow
+            ceiling = math.ceil(math.log(self.maximum / self.initial, self.multiplier)) if 0 < self.initial < self.maximum else 0
+            attempt = min(attempt, ceiling)
+        return random.uniform(0, min(self.maximum, self.initial * self.multiplier ** attempt))
+    def call(self, fn, *params, **kwparams):
+        # fn should return for outcomes that are not worth retrying, and raise otherwise
+        start = time.time()
+        deadline = start + self.deadline if self.deadline is not None else None
+        attempt = 0
+        while True:
+            attempt_start = time.time()
+            if not self.breaker.wait(deadline):
+                with self.lock:
+                    self.giveups += 1
+                    self.retry_time += time.time() - attempt_start
+                raise TimeoutError(f'circuit open past deadline of {self.deadline}s')
+            try:
+                result = fn(*params, **kwparams)
+            except self.retry_on:
+                self.breaker.failure()
+                now = time.time()
+                delay = self.delay(attempt)
+                if deadline is not None and now + delay >= deadline:
+                    with self.lock:
+                        self.giveups += 1
+                        self.retry_time += now - attempt_start
+                    raise
+                time.sleep(delay)
+                with self.lock:
+                    self.retries += 1
+                    self.retry_time += time.time() - attempt_start
+                attempt += 1
+                continue
+            except BaseException:
+                # not retried, but still releases a probe
+                self.breaker.failure()
+                raise
+            self.breaker.success()
+            return result
@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
 import socket
 import requests
-import os, shutil
+import os, mmap, queue, random, shutil
 import sys
 import tqdm
 import av
 import json
 import math
-import fractions, time, logging, concurrent.futures, ar, hashlib, ar.utils, bundlr, flat_tree, nonblocking_stream_queue
+import fractions, threading, time, logging, concurrent.futures, ar, hashlib, ar.utils, bundlr, flat_tree, nonblocking_stream_queue
 import _hashlib
 import subprocess
+from collections import OrderedDict
+from pipeline import OrderedPipeline
+from async_sender import AsyncSender
+from signing import SigningPool
+from retry import RetryPolicy
+from batcher import AdaptiveBatcher
+
+gateway_url = os.environ.get('GATEWAY_URL', ar.PUBLIC_GATEWAYS[1]) # benchmark.py points these at fake_bundlr.py
+bundlr_url = os.environ.get('BUNDLR_URL', bundlr.node.DEFAULT_API_URL)
+transfer_concurrency = 4 # files pulled from the device at once, each over its own port
+transfer_bandwidth = None # bytes per second shared by every pull, or None for as fast as the link goes
+transfer_timeout = 60 # seconds a pull may stall before it stops, keeping what it has to resume
+free_confirmed = False # remove local copies once their upload is read back from the network and matches them
+verify_download = False # confirm uploads by reading them back with download.py, instead of by the digests of what was sent; always done when free_confirmed
 
 def path_to_pre_time(path):
     _, name = path.rsplit('/',1)
@@ -22,52 +36,48 @@ def path_to_pre_time(path):
     return fractions.Fraction(secs+'.'+micros)
 
 def mp4_to_raws(path):
+    # demuxes once, yielding each packet as a view of the mapped file.
+    # the file is read in order, and only the views still in use stay in memory.
     start_time = path_to_pre_time(path)
     with open(path,'rb') as f:
-        try:
-            c = av.open(f)
-        except av.error.InvalidDataError as e:
-            f.seek(0)
-            yield [start_time, f.read(), start_time] # this should be what was yielded
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            yield [start_time, b'', start_time]
             return
-        with c as c, tqdm.tqdm(total=c.size, desc=path.rsplit('/',1)[-1], unit='B', unit_scale=True, unit_divisor=1024, leave=False) as pbar:
-            offset = 0 ### using offset instead of packet.pos outputs the header with the first packet, if wanted
-            for packet in c.demux():
-                #import pdb; pdb.set_trace()
-                if packet.dts is None: # flush
-                    assert not packet.size
-                    continue
-                start = start_time + packet.pts * packet.time_base # pts is real time; the frames can be out of order. dts is algorithmic order for decoding, when frames depend on future data.
-                end = start_time + (packet.pts + packet.duration) * packet.time_base
-                assert packet.size == packet.buffer_size
-                tail = packet.pos + packet.size
-                assert tail > offset
-                #assert tail == f.tell()
-                stash = f.tell()
-                f.seek(offset)
-                if offset == 0:
-                    assert packet.pos > offset
-                    raw = f.read(packet.pos)
-                    yield [start, raw, start]
-                    offset = packet.pos
-                    pbar.update(packet.pos)
-                assert packet.pos == offset
-                #if stash != tail:
-                #    print('fp at', stash, 'but packet ends at', tail)
-                raw = f.read(tail - offset)
-                pbar.update(tail - offset)
-                offset = tail
-                f.seek(stash)
-                #print(start, len(raw), packet, end)
-                yield [start, raw, end]
-            #assert stash == offset
-            f.seek(offset)
-            raw = f.read()
-            yield [end, raw, end]
-            offset += len(raw)
-            pbar.update(len(raw))
-            f.seek(0,2)
-            assert offset == f.tell()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    # the map is closed once the last view of it is released
+    mapped = memoryview(mapped)
+    try:
+        c = av.open(path)
+    except av.error.InvalidDataError as e:
+        yield [start_time, mapped, start_time] # this should be what was yielded
+        return
+    with c as c, tqdm.tqdm(total=size, desc=path.rsplit('/',1)[-1], unit='B', unit_scale=True, unit_divisor=1024, leave=False) as pbar:
+        offset = 0 ### using offset instead of packet.pos outputs the header with the first packet, if wanted
+        end = start_time
+        for packet in c.demux():
+            if packet.dts is None: # flush
+                assert not packet.size
+                continue
+            start = start_time + packet.pts * packet.time_base # pts is real time; the frames can be out of order. dts is algorithmic order for decoding, when frames depend on future data.
+            end = start_time + (packet.pts + packet.duration) * packet.time_base
+            assert packet.size == packet.buffer_size
+            tail = packet.pos + packet.size
+            assert tail > offset
+            if offset == 0:
+                assert packet.pos > offset
+                yield [start, mapped[:packet.pos], start]
+                offset = packet.pos
+                pbar.update(packet.pos)
+            assert packet.pos == offset
+            #print(start, tail - offset, packet, end)
+            yield [start, mapped[offset:tail], end]
+            pbar.update(tail - offset)
+            offset = tail
+        yield [end, mapped[offset:], end]
+        pbar.update(size - offset)
 
 def free_space_bar(name, used, available):#, **kwparams):
     pbar = tqdm.tqdm(
@@ -93,17 +103,67 @@ def free_space_bar(name, used, available):#, **kwparams):
     return pbar
 
 def stream_size_hash(stream, *hashes):
+    # each hash updates on its own thread from the same chunks; hashlib releases the gil
     hashes = [hash() for hash in hashes]
-    size = 0
-    while True:
-        chunk = stream.read(1024*1024)
-        if not len(chunk):
-            break
-        size += len(chunk)
-        for hash in hashes:
+    queues = [queue.Queue(16) for hash in hashes]
+    def update(hash, chunks):
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
             hash.update(chunk)
+    threads = [threading.Thread(target=update, args=(hash, chunks)) for hash, chunks in zip(hashes, queues)]
+    for thread in threads:
+        thread.start()
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(1024*1024)
+            if not len(chunk):
+                break
+            size += len(chunk)
+            for chunks in queues:
+                chunks.put(chunk)
+    finally:
+        for chunks in queues:
+            chunks.put(None)
+        for thread in threads:
+            thread.join()
     return [size, *[hash.hexdigest() for hash in hashes]]
 
+def file_size_hash(path, *hashes):
+    # maps the file and hashes all of it on a thread per hash, so it takes about as long as the slowest
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return [0, *[hash().hexdigest() for hash in hashes]]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            def digest(hash):
+                hash = hash()
+                hash.update(mapped)
+                return hash.hexdigest()
+            with concurrent.futures.ThreadPoolExecutor(len(hashes), thread_name_prefix='hash') as pool:
+                return [size, *pool.map(digest, hashes)]
+
+def verify_pull(device_file, local_file):
+    # the device runs b2sum on its copy while the pulled .part is hashed here.
+    # the .part only takes the file's name once it matches, and is discarded otherwise.
+    # a .part shorter than the device's file is kept for the next pull to resume, returning None.
+    part = local_file.part()
+    if part.size < device_file.size:
+        return None
+    with concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='b2sum') as pool:
+        device_b2sum = pool.submit(device_file.b2sum)
+        digests = part.digests()
+        verified = digests['size'] == device_file.size and digests['blake2b'] == device_b2sum.result()
+    if verified:
+        part.rename(local_file)
+    else:
+        part.discard()
+    return verified
+
 class JSONEncoder(json.JSONEncoder):
     def iterencode(self, o, _one_shot=False):
         if self.check_circular:
@@ -163,12 +223,16 @@ class Local:
     def __init__(self):
         self.path = os.path.basename(__file__).rsplit('.',1)[0]+'_stash'
         os.makedirs(self.path, exist_ok=True)
+        self.digests = {} # (path, size, mtime) -> digests of files hashed this run
     def get(self, fn):
         fn = fn.rsplit('/',1)[-1]
         return self.File(self, fn)
-    def send(self, fn, stream):
+    def send(self, fn, stream, offset=0):
+        # offset: bytes already in the file to keep, from a pull that was cut off
         fn = fn.rsplit('/',1)[-1]
-        with open(os.path.join(self.path, fn), 'wb') as f:
+        with open(os.path.join(self.path, fn), 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
             for chunk in stream:
                 f.write(chunk)
     def confirm(self, fn, confirmation):
@@ -194,25 +258,86 @@ class Local:
                 return json.load(f)
         def recv_raws(self):
             return mp4_to_raws(self.path)
+        def digests(self):
+            # size, sha256 and blake2b, hashed once for each size and mtime
+            stat = os.stat(self.path)
+            key = (self.path, stat.st_size, stat.st_mtime_ns)
+            digests = self._local.digests.get(key)
+            if digests is None:
+                size, sha256, blake2b = file_size_hash(self.path, hashlib.sha256, hashlib.blake2b)
+                digests = dict(size = size, sha256 = sha256, blake2b = blake2b)
+                self._local.digests[key] = digests
+            return digests
+        def confirm_upload(self, read_back=False, **sent):
+            # records that the digests of what was uploaded match the file.
+            # read_back: the digests are of the upload downloaded again, so rm may free the file
+            assert len(sent)
+            digests = self.digests()
+            if any((digests[name] != digest for name, digest in sent.items())):
+                return False
+            with open(self.path + '.verified', 'w') as f:
+                json.dump(dict(**digests, mtime = os.stat(self.path).st_mtime_ns, read_back = read_back), f)
+            return True
+        def _confirmation(self):
+            try:
+                with open(self.path + '.verified') as f:
+                    record = json.load(f)
+            except (FileNotFoundError, ValueError):
+                return None
+            stat = os.stat(self.path)
+            if record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns:
+                return record
+        @property
+        def confirmed(self):
+            return self._confirmation() is not None
+        @property
+        def read_back(self):
+            record = self._confirmation()
+            return record is not None and record.get('read_back', False)
         def rm(self):
+            # frees the space of a copy only once its upload has been read back and matched
+            assert self.read_back, f'{self.path} is not confirmed uploaded'
+            os.unlink(self.path)
+            os.unlink(self.path + '.verified')
+        def discard(self):
+            # a copy that failed verification, to be pulled again
             os.unlink(self.path)
+        def rename(self, other):
+            # the digests hashed under the old name still hold under the new one
+            stat = os.stat(self.path)
+            digests = self._local.digests.pop((self.path, stat.st_size, stat.st_mtime_ns), None)
+            os.replace(self.path, other.path)
+            if digests is not None:
+                self._local.digests[(other.path, stat.st_size, stat.st_mtime_ns)] = digests
         @property
         def size(self):
             return os.path.getsize(self.path)
         def locator(self):
             return type(self)(self._local, self._fn + '.locator')
+        def part(self):
+            # where the file is pulled to until it is verified
+            return type(self)(self._local, self._fn + '.part')
     @property
     def available(self):
         total, used, free = shutil.disk_usage(self.path)
         return free
     def videos(self):
-        return [self.File(self, subpath) for subpath in os.listdir(self.path)]
+        return [
+            self.File(self, subpath)
+            for subpath in os.listdir(self.path)
+            if not subpath.endswith(('.locator', '.verified', '.part'))
+        ]
 
 class HDC:
     def __init__(self):
         self.host = '192.168.0.10'
         self.protohost = 'http://'+self.host+':'
         self.videopath = '/mnt/usb/recording/video/'
+        self.listings = {} # dir -> name -> dict(size, mtime, b2sum) from the last listing
+        self.results = OrderedDict() # (path, command, size, mtime) -> output, least recently used first
+        self.result_count = 4096
+        self.manifests = {} # dir -> name -> command -> dict(size, mtime, result), as on the device
+        self.cache_lock = threading.Lock()
         self.session = requests.Session()
         self._req('GET', 5000, 'ping', timeout=1)
     def cmd(self, cmd):
@@ -232,6 +357,99 @@ class HDC:
     #        return True
     #    except requests.ConnectionError:
     #        return False
+    def listing(self, dir, hashes=False):
+        # name -> dict(size, mtime[, b2sum]) of everything in dir, from one command.
+        # hashes of files whose size and mtime are unchanged are kept from the last
+        # listing or the cache, and the rest are computed together in one more command
+        # and cached as File.b2sum would.
+        dir = dir.rstrip('/')
+        assert "'" not in dir
+        old = self.listings.get(dir, {})
+        table = {}
+        for line in self.cmd(f"cd '{dir}' && stat -c '%s %Y %n' -- *").split('\n'):
+            fields = line.split(' ', 2)
+            if len(fields) != 3 or not fields[0].isdigit() or not fields[1].isdigit():
+                # errors, e.g. for the unexpanded * of an empty directory
+                continue
+            size, mtime, name = fields
+            entry = dict(size = int(size), mtime = int(mtime))
+            cached = old.get(name)
+            if cached is not None and 'b2sum' in cached and cached['size'] == entry['size'] and cached['mtime'] == entry['mtime']:
+                entry['b2sum'] = cached['b2sum']
+            table[name] = entry
+        self.listings[dir] = table
+        if hashes:
+            stale = []
+            for name, entry in table.items():
+                if 'b2sum' in entry or "'" in name:
+                    continue
+                result = self.cached(f'{dir}/{name}', 'b2sum', entry['size'], entry['mtime'])
+                if result is not None:
+                    entry['b2sum'] = result.split(' ',1)[0]
+                else:
+                    stale.append(name)
+            if len(stale):
+                names = ' '.join((f"'{name}'" for name in stale))
+                results = []
+                for line in self.cmd(f"cd '{dir}' && b2sum -- {names}").split('\n'):
+                    digest, _, name = line.partition('  ')
+                    if name in table:
+                        entry = table[name]
+                        entry['b2sum'] = digest
+                        # the output of b2sum on the file's full path
+                        results.append((f'{dir}/{name}', 'b2sum', entry['size'], entry['mtime'], f'{digest}  {dir}/{name}\n'))
+                self.store_many(results)
+        return table
+    manifest_name = '.cache_manifest.json' # per directory on the device, holding the outputs of cached calls
+    def manifest(self, dir):
+        # needs cache_lock. fetched once, then kept up to date as results are stored.
+        manifest = self.manifests.get(dir)
+        if manifest is None:
+            try:
+                manifest = json.loads(self.cmd(f"cat '{dir}/{self.manifest_name}' 2>/dev/null"))
+            except ValueError:
+                manifest = {}
+            self.manifests[dir] = manifest
+        return manifest
+    def cached(self, path, call, size, mtime):
+        # the output of call on path when it had this size and mtime, or None
+        key = (path, call, size, mtime)
+        with self.cache_lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                return result
+            dir, name = path.rsplit('/',1)
+            entry = self.manifest(dir).get(name, {}).get(call)
+            if entry is None or entry['size'] != size or entry['mtime'] != mtime:
+                return None
+            self._remember(key, entry['result'])
+            return entry['result']
+    def store(self, path, call, size, mtime, result):
+        self.store_many([(path, call, size, mtime, result)])
+    def store_many(self, results):
+        # results: (path, call, size, mtime, output) tuples. each directory's manifest is written once.
+        with self.cache_lock:
+            stored = {} # dir -> names stored
+            for path, call, size, mtime, result in results:
+                self._remember((path, call, size, mtime), result)
+                dir, name = path.rsplit('/',1)
+                self.manifest(dir).setdefault(name, {})[call] = dict(size = size, mtime = mtime, result = result)
+                stored.setdefault(dir, set()).add(name)
+            for dir, names in stored.items():
+                manifest = self.manifest(dir)
+                listing = self.listings.get(dir)
+                if listing is not None:
+                    # files gone from the device are dropped along the way
+                    for gone in [gone for gone in manifest if gone not in listing and gone not in names]:
+                        del manifest[gone]
+                self.File(self, f'{dir}/{self.manifest_name}').set(json.dumps(manifest))
+    def _remember(self, key, result):
+        # needs cache_lock
+        self.results[key] = result
+        self.results.move_to_end(key)
+        while len(self.results) > self.result_count:
+            self.results.popitem(last=False)
     def _req(self, method, port, path='', **kwparams):
         try:
             return self.session.request(method, self.protohost + str(port) + '/' + path, **kwparams)
@@ -239,11 +457,11 @@ class HDC:
             raise
 
     class File:
-        def __init__(self, hdc, path, size=None):
+        def __init__(self, hdc, path, stat=None):
+            # stat: an entry of HDC.listing, answering size, post_time and b2sum without a request
             self.hdc = hdc
             self.path = path
-            if size is not None:
-                self.size = size
+            self.stat = stat
             assert "'" not in path
         @property
         def pre_time(self):
@@ -259,16 +477,24 @@ class HDC:
             assert not 'filename was not sec micro, could use stat -c %W or %X'
         @property
         def post_time(self):
+            if self.stat is not None:
+                return self.stat['mtime']
             return self.call('stat -c %Y', type=int)
-        def cachefile(self, fn):
-            dir, name = self.path.rsplit('/',1)
-            return type(self)(self.hdc,f'{dir}/.{name}.cache.{fn}')
+        def identity(self):
+            # size and mtime, from the listing or one request
+            if self.stat is None:
+                size, mtime = self.hdc.cmd(f"stat -c '%s %Y' '{self.path}'").split()
+                self.stat = dict(size = int(size), mtime = int(mtime))
+            return self.stat['size'], self.stat['mtime']
         def call(self, call, cache=False, check=False, type=None, status=False):
+            # cache: reuse the output for as long as the file's size and mtime are unchanged.
+            #        outputs are kept in memory and in the directory's manifest on the device.
+            # check: run the command even if cached, replacing a cached output that differs
+            cacheresult = None
             if cache:
-                cache = self.cachefile(call.replace(' ','_'))
-                if cache.exists:
-                    cacheresult = cache.cat()
-            if not cache or not cache.exists or check:
+                size, mtime = self.identity()
+                cacheresult = self.hdc.cached(self.path, call, size, mtime)
+            if cacheresult is None or check:
                 if status:
                     if status == 'keepoutput':
                         cmdresult = self.hdc.cmd(f"{call} '{self.path}'; echo $?")
@@ -276,12 +502,10 @@ class HDC:
                         cmdresult = self.hdc.cmd(f"{call} '{self.path}' > '/dev/null'; echo $?")
                 else:
                     cmdresult = self.hdc.cmd(f"{call} '{self.path}'")
-                if check and cache and cache.exists:
-                    if cmdresult != cacheresult:
-                        print('outdated:', call, cacheresult)
-                        assert self.hdc.cmd(f"rm '{self.cachefile('').path}'*; echo $?").strip() == '0'
-                if cache and not cache.exists:
-                    cache.set(cmdresult)
+                if cacheresult is not None and cmdresult != cacheresult:
+                    print('outdated:', call, cacheresult)
+                if cache and cmdresult != cacheresult:
+                    self.hdc.store(self.path, call, size, mtime, cmdresult)
                 result = cmdresult
             else:
                 result = cacheresult
@@ -290,21 +514,30 @@ class HDC:
             return type(result)
         @property
         def exists(self):
+            if self.stat is not None:
+                # as of the listing
+                return True
             return self.call('test -e', status=True) == 0
         def cat(self):
             return self.call('cat')
         def rm(self):
             assert self.call('rm', status=True) == 0
+            self.stat = None
         def set(self, str):
             EOF = 'EOF'
             while EOF in str:
-                EOF = base64.b64encode(random.randbytes(16))
-            assert self.hdc.cmd(f"cat <<{EOF} | head -c -1 >'{self.path}'; echo $?\n{str}\n{EOF}").rstrip() == '0'
+                EOF = random.randbytes(16).hex()
+            # quoted, so the shell leaves $ and ` in the text alone
+            assert self.hdc.cmd(f"cat <<'{EOF}' | head -c -1 >'{self.path}'; echo $?\n{str}\n{EOF}").rstrip() == '0'
         def b2sum(self):
             #self.size # checks size is same
-            return self.call('b2sum').rsplit(' ',1)[0]#, cache=True).rsplit(' ',1)[0]
+            if self.stat is not None and 'b2sum' in self.stat:
+                return self.stat['b2sum']
+            return self.call('b2sum', cache=True).split(' ',1)[0]
         @property
         def size(self):
+            if self.stat is not None:
+                return self.stat['size']
             return self.call('stat -c %s', type=int)#, cache=True, check=True)
         @property
         def subfiles(self):
@@ -316,34 +549,161 @@ class HDC:
         def recv_prep(self):
             self.prepped = True
             self.port = (int.from_bytes(hashlib.sha256(self.path.encode()).digest(),'little') % 32768) + 32768
-        def recv(self, chunk=1024*1024):
+        def recv(self, chunk=1024*1024, offset=0, throttle=None, size=None, timeout=None):
+            # yields views of one reused buffer, each valid until the next is taken.
+            # offset: byte of the file to start from
+            # timeout: seconds to wait on a stalled connection before raising
             assert self.prepped
             self.prepped = False
-            self.hdc.cmd(f"nc -l -p {self.port} < '{self.path}' > /dev/null 2>&1 &")
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-            sock.connect((self.hdc.host, self.port))
-            with tqdm.tqdm(desc=self.path.rsplit('/',1)[1],total=self.size,unit='B',unit_divisor=1024,unit_scale=True,leave=False) as pbar:
+            if offset:
+                self.hdc.cmd(f"tail -c +{offset + 1} '{self.path}' | nc -l -p {self.port} > /dev/null 2>&1 &")
+            else:
+                self.hdc.cmd(f"nc -l -p {self.port} < '{self.path}' > /dev/null 2>&1 &")
+            sock = self._connect(timeout=timeout)
+            buffer = memoryview(bytearray(chunk))
+            with sock, tqdm.tqdm(desc=self.path.rsplit('/',1)[1],initial=offset,total=self.size if size is None else size,unit='B',unit_divisor=1024,unit_scale=True,leave=False) as pbar:
                 while True:
-                    data = sock.recv(chunk)
-                    if not data:
+                    count = sock.recv_into(buffer)
+                    if not count:
                         break
-                    yield data
-                    pbar.update(len(data))
+                    if throttle is not None:
+                        throttle.wait(count)
+                    yield buffer[:count]
+                    pbar.update(count)
+        def _connect(self, attempts=50, timeout=None):
+            # nc is started in the background, and may not be listening yet
+            for attempt in range(attempts):
+                try:
+                    return socket.create_connection((self.hdc.host, self.port), timeout)
+                except ConnectionRefusedError:
+                    if attempt + 1 == attempts:
+                        raise
+                    time.sleep(0.1)
     @property
     def available(self):
         header, avail = self.cmd(f"df --output=avail {self.videopath}").rstrip().split('\n')
         assert header.lstrip() == 'Avail'
         return int(avail) * 1024
-    def videos(self):
-        return self.File(self, self.videopath).subfiles
+    def videos(self, hashes=False):
+        dir = self.videopath.rstrip('/')
+        return [
+            self.File(self, f'{dir}/{name}', stat)
+            for name, stat in self.listing(dir, hashes).items()
+        ]
+
+class Throttle:
+    def __init__(self, rate):
+        '''
+        Paces the readers sharing it to rate bytes per second in total.
+        '''
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+    def wait(self, count):
+        # called after reading count bytes. sleeping holds the sender back through tcp flow control.
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + count / self.rate
+            delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+class Transfers:
+    def __init__(self, local, concurrency=4, bandwidth=None, chunk=1024*1024, timeout=60):
+        '''
+        Pulls files from the device several at a time, each over its own port,
+        into a .part beside the file's name. A .part left by an earlier pull
+        is continued from where it ends.
+
+        local: Local to write the files into
+        concurrency: files pulled at once
+        bandwidth: bytes per second shared by all pulls, or None for as fast as the link goes
+        chunk: bytes per socket read, into a buffer each pull reuses
+        timeout: seconds a pull may stall before it stops, leaving its .part to be resumed
+        '''
+        self.local = local
+        self.concurrency = concurrency
+        self.throttle = Throttle(bandwidth) if bandwidth else None
+        self.chunk = chunk
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.ports = set() # ports of pulls in progress
+        self.reserved = 0 # local bytes that pulls in progress have yet to write
+        self.out_of_space = False
+    def pull(self, videos):
+        # yields (video, bytes pulled) of [video, size] pairs as each finishes.
+        # skips files that don't fit locally once the pulls in progress are done, setting out_of_space.
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency, thread_name_prefix='pull') as pool:
+            for video, size in videos:
+                part = self.local.get(video.path).part()
+                # a .part as long as the file was pulled whole but not yet verified
+                offset = part.size if part.exists and part.size <= size else 0
+                if len(pending) >= self.concurrency:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                while True:
+                    with self.lock:
+                        # available already excludes what pulls in progress have written
+                        fits = size - offset <= self.local.available - self.reserved
+                        if fits:
+                            self.reserved += size - offset
+                    if fits or not len(pending):
+                        break
+                    # pulls in progress can end short of their reservation
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                if not fits:
+                    self.out_of_space = True
+                    continue
+                pending.add(pool.submit(self._pull, video, size, offset))
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+    def _pull(self, video, size, offset):
+        with self.lock:
+            # hashed ports can collide, and two pulls can't share one
+            port = video.port
+            while port in self.ports:
+                port = 32768 + (port + 1) % 32768
+            self.ports.add(port)
+        video.port = port
+        reserved = size - offset
+        def written(stream):
+            # each chunk is written by the time the next is asked for, and then takes up available space instead
+            nonlocal reserved
+            for chunk in stream:
+                yield chunk
+                with self.lock:
+                    count = min(len(chunk), reserved)
+                    self.reserved -= count
+                    reserved -= count
+        try:
+            self.local.send(video.path + '.part', written(video.recv(self.chunk, offset, self.throttle, size, self.timeout)), offset)
+        except OSError as exc:
+            # a stalled or dropped connection. what arrived stays in the .part for the next pull.
+            print(f'{video.path}: {exc}', file=sys.stderr)
+        finally:
+            with self.lock:
+                self.ports.discard(port)
+                self.reserved -= reserved
+        return video, size - offset - reserved
 
 class ArDItemLengths:
-    def __init__(self):#, **tags):
+    def __init__(self, signing_workers=None, retry_policy=None, min_at_once=4, max_at_once=64, chunk_size=100000):#, **tags):
         try:
             self.wallet = ar.Wallet('identity.json')
         except:
             print('.. identity.json ..')
             self.wallet = ar.Wallet.generate(jwk_file='identity.json')
+        # signing processes are kept across files
+        self.signer = SigningPool('identity.json', signing_workers) if signing_workers else None
+        # one backoff and circuit breaker across files
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        # batch sizes learned from upload latency carry over between files
+        self.batcher = AdaptiveBatcher(min_at_once, max_at_once)
+        self.chunk_size = chunk_size
         #self.bundlrstorage = self.BundlrStorage(**tags)
     #@property
     #def connected(self):
@@ -357,17 +717,37 @@ class ArDItemLengths:
             if isinstance(val, _hashlib.HASH) or isinstance(val, hashlib.blake2b) or isinstance(val, hashlib.blake2s)
         }
 
-        bundlrstorage = self.BundlrStorage(self.wallet)
+        bundlrstorage = self.BundlrStorage(self.wallet, signer=self.signer, retry_policy=self.retry_policy, batcher=self.batcher)
+        batcher = self.batcher
+        chunk_size = self.chunk_size
         indices = flat_tree.flat_tree(bundlrstorage, 3)
+        def index_data(raws, new_idx):
+            for hash in hash_algs.values():
+                for _, raw, _ in raws:
+                    hash.update(raw)
+            # only the index items carry the running hashes; data is uploading concurrently
+            bundlrstorage.index_tags = {
+                **tags,
+                **{ name: alg.hexdigest() for name, alg in hash_algs.items() }
+            }
+            indices.append(
+                sum([len(raw) for _, raw, _ in raws]),
+                new_idx
+            )
+            bundlrstorage.index_tags = {}
         raws = []
         for pre_time, next_buf, post_time in raws_iter:
-            if len(next_buf) <= 100000:
+            queued = len(raws)
+            if len(next_buf) <= chunk_size:
                 raws.append([pre_time, next_buf, post_time])
             else:
+                # views share the buffer instead of copying each chunk out
+                next_buf = memoryview(next_buf)
                 raws.extend([
-                    [pre_time, next_buf[off:off+100000], post_time]
-                    for off in range(0, len(next_buf), 100000)
+                    [pre_time, next_buf[off:off+chunk_size], post_time]
+                    for off in range(0, len(next_buf), chunk_size)
                 ])
+            batcher.arrived(len(raws) - queued)
             #while len(buf) < 100000*64:
             #    try:
             #        buf += next(stream)
@@ -381,32 +761,39 @@ class ArDItemLengths:
             #buf = buf[100000*64:]
             #time = path_to_pre_time(fn)
 
-            while len(raws):
-                new_idx = bundlrstorage.store_data(raws[:64])
-                for hash in hash_algs.values():
-                    for _, raw, _ in raws[:64]:
-                        hash.update(raw)
-                bundlrstorage.tags = {
-                    **tags,
-                    **{ name: alg.hexdigest() for name, alg in hash_algs.items() }
-                }
-                indices.append(
-                    sum([len(raw) for _, raw, _ in raws[:64]]),
-                    new_idx
-                )
-                bundlrstorage.tags = {}
-                raws = raws[64:]
+            # packets are gathered until a batch is worth its confirmation and index uploads
+            while len(raws) >= batcher.target:
+                at_once = batcher.take(len(raws))
+                bundlrstorage.queue_data(raws[:at_once])
+                raws = raws[at_once:]
+                for batch, new_idx in bundlrstorage.finished_data():
+                    index_data(batch, new_idx)
                 #prev_indices_id = indices.locator
                 #if first is None:
                 #    first = prev_indices_id['ditem'][0]
                 #    start_block = self.bundlrstorage.current_block['indep_hash']
+        while len(raws):
+            at_once = batcher.take(len(raws))
+            bundlrstorage.queue_data(raws[:at_once])
+            raws = raws[at_once:]
+        for batch, new_idx in bundlrstorage.finished_data(wait=True):
+            index_data(batch, new_idx)
+        bundlrstorage.shutdown()
+        print(f'metadata overhead {batcher.overhead:.2%} of captured bytes', file=sys.stderr)
         return json.dumps(indices.locator, cls=JSONEncoder) #prev_indices_id)
 
     class BundlrStorage:
-        def __init__(self, wallet=PermissionError('no wallet provided'), **tags):
-            self.peer = ar.Peer(ar.PUBLIC_GATEWAYS[1], timeout=1)
-            self.node = bundlr.Node(timeout=1)
+        def __init__(self, wallet=PermissionError('no wallet provided'), max_workers=4, max_pending=2, async_connections=None, async_window=256, signer=None, retry_policy=None, batcher=None, **tags):
+            self.peer = ar.Peer(gateway_url, timeout=1)
+            self.node = bundlr.Node(bundlr_url, timeout=1)
+            self.sender = AsyncSender(self.node.api_url, async_connections, async_window, timeout=1) if async_connections else None
+            self.signer = signer
+            self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+            self.batcher = batcher
             self.tags = tags
+            self.index_tags = {}
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='send')
+            self.pipeline = OrderedPipeline(max_pending, 'store_data')
             self._current_block = self.peer.current_block()
             self._last_block_time = time.time()
             self.node.info()
@@ -430,8 +817,11 @@ class ArDItemLengths:
             return self._current_block
         def store_index(self, metadata):
             data = json.dumps(metadata, cls=JSONEncoder).encode()
-            result = self.send(data)
-            confirmation = self.send(json.dumps(result, cls=JSONEncoder).encode())
+            result = self.send(data, **self.index_tags)
+            confirmation = json.dumps(result, cls=JSONEncoder).encode()
+            if self.batcher is not None:
+                self.batcher.indexed(len(data) + len(confirmation))
+            confirmation = self.send(confirmation, **self.index_tags)
             sha256 = hashlib.sha256()
             sha256.update(data)
             sha256 = sha256.hexdigest()
@@ -446,15 +836,33 @@ class ArDItemLengths:
                 sha256 = sha256,
                 blake2b = blake2b,
             )
+        def queue_data(self, raws):
+            # uploads in the background; results come back in order from finished_data
+            self.pipeline.submit(lambda: (raws, self.store_data(raws)))
+        def finished_data(self, wait=False):
+            return self.pipeline.completed(wait)
+        def shutdown(self):
+            self.pipeline.shutdown()
+            self.pool.shutdown()
+            if self.sender is not None:
+                self.sender.close()
         def store_data(self, raws):
-            global last_post_time # so it can start prior to imports
             #global dropped_ct, dropped_size # for quick implementation
             #data_array = []
             #for offset in range(0,len(raw),100000):
             #    data_array.append(send(raw[offset:offset+100000]))
             #data_array = [self.send(raw) for pre_time, raw, post_time in raws]
-            data_array = list(concurrent.futures.ThreadPoolExecutor(max_workers=4).map(self.send, [raw for pre_time, raw, post_time in raws]))
-            confirmation = self.send(json.dumps(data_array, cls=JSONEncoder).encode())
+            start = time.time()
+            if self.sender is not None:
+                # every chunk goes out at once over the sender's pooled connections
+                dis = self.sign_many([raw for pre_time, raw, post_time in raws])
+                data_array = self.send_signed_many(dis)
+            else:
+                data_array = list(self.pool.map(self.send, [raw for pre_time, raw, post_time in raws]))
+            confirmation = json.dumps(data_array, cls=JSONEncoder).encode()
+            if self.batcher is not None:
+                self.batcher.uploaded(len(raws), sum((len(raw) for pre_time, raw, post_time in raws)), len(confirmation), time.time() - start)
+            confirmation = self.send(confirmation)
             sha256 = hashlib.sha256()
             for pre, raw, post in raws:
               sha256.update(raw)
@@ -479,18 +887,53 @@ class ArDItemLengths:
                 #    time = last_post_time,
                 #) if dropped_ct else None,
             )
-        def send(self, data, **tags):
-            di = ar.DataItem(data = data)
-            di.header.tags = [
+        def sign(self, data, **tags):
+            tags = [
                 ar.utils.create_tag(key, val, True)
                 for key, val in {**self.tags, **tags}.items()
             ]
+            if self.signer is not None:
+                return self.signer.sign(data, tags)
+            di = ar.DataItem(data = data)
+            di.header.tags = tags
             di.sign(self.wallet.rsa)
-            while True:
+            return di
+        def sign_many(self, datas, **tags):
+            if self.signer is not None:
+                return self.signer.sign_many(datas, [
+                    ar.utils.create_tag(key, val, True)
+                    for key, val in {**self.tags, **tags}.items()
+                ])
+            return [self.sign(data, **tags) for data in datas]
+        def send(self, data, **tags):
+            return self.send_signed(self.sign(data, **tags))
+        def payload(self, di):
+            # the asyncio sender writes the header and the chunk's own buffer out without joining them
+            if self.sender is not None:
+                return (di.header.tobytes(), di.data)
+            return di.tobytes()
+        def send_signed_many(self, dis):
+            # sends all at once when the node is up, and retries the ones that fail one at a time
+            breaker = self.retry_policy.breaker
+            deadline = time.time() + self.retry_policy.deadline if self.retry_policy.deadline is not None else None
+            if not breaker.wait(deadline):
+                raise TimeoutError(f'circuit open past deadline of {self.retry_policy.deadline}s')
+            results = self.sender.send_txs([self.payload(di) for di in dis])
+            # the batch counts as one call, which also releases a probe
+            if all((isinstance(result, Exception) for result in results)) and len(results):
+                breaker.failure()
+            else:
+                breaker.success()
+            return [
+                self.send_signed(di) if isinstance(result, Exception) else result
+                for di, result in zip(dis, results)
+            ]
+        def send_signed(self, di):
+            sender = self.node if self.sender is None else self.sender
+            def attempt():
                 try:
                     start = time.time()
-                    result = self.node.send_tx(di.tobytes())
-                    break
+                    return sender.send_tx(self.payload(di))
                 except ar.ArweaveNetworkException as exc:
                     message, status_code, cause, response = exc.args
                     if status_code == 201: # transaction already received
@@ -500,11 +943,12 @@ class ArDItemLengths:
                         )
                     logging.exception(exc)
                     print(exc, file=sys.stderr)
-                    continue
+                    raise
                 except Exception as exc:
                     print(exc, file=sys.stderr)
-                    continue
-            return result
+                    raise
+            # backs off, and waits with every other sender while the node is down
+            return self.retry_policy.call(attempt)
 
 def main():
     print('Observing ...')
@@ -531,12 +975,21 @@ def main():
         if remote_connected:
             for v in tqdm.tqdm(local.videos(), desc='Sending', unit='m'):
                 locator_path = v.path + '.locator'
-                import pdb; pdb.set_trace()
-                raws = list(v.recv_raws())
                 if not os.path.exists(locator_path):
-                    locator = remote.send_raws(v.recv_raws(), fn=v.path.rsplit('/',1)[-1], sha256 = hashlib.sha256(), blake2b = hashlib.blake2b())
+                    hashes = dict(sha256 = hashlib.sha256(), blake2b = hashlib.blake2b())
+                    locator = remote.send_raws(v.recv_raws(), fn=v.path.rsplit('/',1)[-1], **hashes)
                     with open(locator_path, 'w') as f:
                         f.write(locator)
+                    # the hashes ran over every byte sent
+                    sent = {name: hash.hexdigest() for name, hash in hashes.items()}
+                    if verify_download or free_confirmed:
+                        # waits for the stream to be readable from the network.
+                        # what was sent is not enough to free the only local copy.
+                        with subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'download.py'), locator_path], stdout=subprocess.PIPE) as proc:
+                            size, sha256, blake2b = stream_size_hash(proc.stdout, hashlib.sha256, hashlib.blake2b)
+                        sent = dict(size = size, sha256 = sha256, blake2b = blake2b, read_back = True) if proc.returncode == 0 else None
+                    if sent is None or not v.confirm_upload(**sent):
+                        print(f'{v.path} does not match what was uploaded', file=sys.stderr)
                 else:
                     with open(locator_path, 'r') as f:
                         locator = f.read()
@@ -551,6 +1004,8 @@ def main():
                # 
                # if size == v.size and sha256 == v.sha256 and 
                # local.File(local, v
+                if free_confirmed and v.read_back:
+                    v.rm()
         elif hdc_connected:
             with hdc_usage:
                 videos = []
@@ -558,24 +1013,36 @@ def main():
                     size = v.size
                     hdc_usage.update(size, None)
                     local_v = local.get(v.path)
+                    # only verified pulls have the file's name; a .part of it is resumed
                     if not local_v.exists or size != local_v.size: # or v.b2sum != local_v.b2sum:
                         videos.append([v, size])
                         v.recv_prep()
                 printed_notice = False
-                with tqdm.tqdm(videos, desc='Retrieving', unit='m') as pbar:
-                    for video, video_size in pbar:
+                transfers = Transfers(local, transfer_concurrency, transfer_bandwidth, timeout=transfer_timeout)
+                # pulled files are checked against the device while the rest transfer
+                verifier = concurrent.futures.ThreadPoolExecutor(transfer_concurrency, thread_name_prefix='verify')
+                verifications = []
+                with tqdm.tqdm(total=len(videos), desc='Retrieving', unit='m') as pbar:
+                    for video, pulled_size in transfers.pull(videos):
+                        local_video = local.get(video.path)
+                        verifications.append((local_video, verifier.submit(verify_pull, video, local_video)))
                         #if video_size + local_size > (local.available + local_size) // 2 and not printed_notice:
                         #    local_usage.desc = 'Local usage exceeds local free !!'
                         #    #pbar.display('local usage exceeds local free; free some space or upload')
                         #    #print()
                         #    #pbar.update()
                         #    #printed_notice = True
-                        if video_size > local.available:
-                            #print()
-                            pbar.display('ran out of disk space locally')
-                            break
-                        local.send(video.path, video.recv())
-                        local_usage.update(video_size, local.available)
+                        local_usage.update(pulled_size, local.available)
+                        pbar.update()
+                    for local_video, verification in verifications:
+                        verified = verification.result()
+                        if verified is None:
+                            print(f'{local_video.path} was pulled in part, and is kept to resume', file=sys.stderr)
+                        elif not verified:
+                            print(f'{local_video.path} does not match the device, discarding it', file=sys.stderr)
+                    verifier.shutdown()
+                    if transfers.out_of_space:
+                        pbar.display('ran out of disk space locally')
                     else:
                         pbar.display('Done.')
                     pbar.refresh()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# signs DataItems in worker processes so RSA-PSS work is not serialized by the GIL.
+# chunk data reaches the workers through preallocated shared memory slots, and
+# only the small signed header comes back; the caller's data is reused as-is.
+
+import concurrent.futures, json, multiprocessing, os, queue, sys, time
+from multiprocessing import resource_tracker, shared_memory
+import ar
+
+_wallet = None
+_slots = {}
+
+def _init_worker(jwk_file):
+    global _wallet
+    _wallet = ar.Wallet(jwk_file)
+
+def _attach(name):
+    slot = _slots.get(name)
+    if slot is None:
+        # the parent owns the slot and unlinks it. an attach that registers it too leaves the
+        # resource tracker warning of leaks, or unlinking it again, once the worker exits.
+        try:
+            slot = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before python 3.13 attaching always registers; workers run one call at a time
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                slot = shared_memory.SharedMemory(name)
+            finally:
+                resource_tracker.register = register
+        _slots[name] = slot
+    return slot
+
+def _sign_slot(name, length, tags):
+    view = _attach(name).buf[:length]
+    try:
+        return _sign_bytes(view, tags)
+    finally:
+        view.release()
+
+def _sign_bytes(data, tags):
+    di = ar.DataItem(data = data)
+    di.header.tags = tags
+    di.sign(_wallet.rsa)
+    return di.header
+
+class SigningPool:
+    def __init__(self, jwk_file='identity.json', workers=None, slots=None, slot_size=256*1024):
+        '''
+        jwk_file: wallet to sign with; each worker loads it once
+        workers: number of signing processes, defaults to the cpu count
+        slots: number of shared memory slots, bounding items being signed at once.
+               submitting more waits for a slot.
+        slot_size: largest data that goes through shared memory. larger data
+                   is pickled to the worker instead.
+        '''
+        workers = workers or os.cpu_count()
+        self.slot_size = slot_size
+        # fork, because spawn would rerun the capture script's top level in each worker
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker,
+            initargs=(jwk_file,),
+        )
+        # every worker forks now, from the threads the caller has so far; later forks would copy
+        # whatever locks the caller's threads hold by then
+        for future in [self.executor.submit(os.getpid) for idx in range(workers)]:
+            future.result()
+        self.slots = queue.Queue()
+        self._all_slots = []
+        for idx in range(slots or workers * 2):
+            slot = shared_memory.SharedMemory(create=True, size=slot_size)
+            self._all_slots.append(slot)
+            self.slots.put(slot)
+    def __enter__(self):
+        return self
+    def __exit__(self, *params):
+        self.close()
+    def submit(self, data, tags=[]):
+        # returns a future of an ar.DataItem wrapping data with a signed header
+        result = concurrent.futures.Future()
+        if len(data) > self.slot_size:
+            # views can't be pickled; bytes pass through as they are
+            future = self.executor.submit(_sign_bytes, bytes(data), tags)
+            slot = None
+        else:
+            slot = self.slots.get()
+            slot.buf[:len(data)] = data
+            future = self.executor.submit(_sign_slot, slot.name, len(data), tags)
+        def done(future):
+            if slot is not None:
+                self.slots.put(slot)
+            try:
+                result.set_result(ar.DataItem(header = future.result(), data = data))
+            except Exception as exc:
+                result.set_exception(exc)
+        future.add_done_callback(done)
+        return result
+    def sign(self, data, tags=[]):
+        return self.submit(data, tags).result()
+    def sign_many(self, datas, tags=[]):
+        return [future.result() for future in [self.submit(data, tags) for data in datas]]
+    def close(self):
+        self.executor.shutdown()
+        for slot in self._all_slots:
+            slot.close()
+            slot.unlink()
+        self._all_slots.clear()
+
+if __name__ == '__main__':
+    # reports items/s signed with 1..N worker processes. usage: signing.py [N] [items] [jwk_file]
+    import tempfile
+    defaults = [os.cpu_count(), 64, None]
+    max_workers, count, jwk_file = [*sys.argv[1:4], *defaults[len(sys.argv[1:4]):]]
+    max_workers, count = int(max_workers), int(count)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if jwk_file is None:
+            jwk_file = os.path.join(tmpdir, 'identity.json')
+            ar.Wallet.generate(jwk_file=jwk_file)
+        wallet = ar.Wallet(jwk_file)
+        datas = [os.urandom(100000) for idx in range(count)]
+        tags = [ar.utils.create_tag('Benchmark', 'signing', True)]
+        start = time.time()
+        for data in datas:
+            di = ar.DataItem(data = data)
+            di.header.tags = tags
+            di.sign(wallet.rsa)
+        results = dict(in_process = count / (time.time() - start))
+        for workers in range(1, max_workers + 1):
+            with SigningPool(jwk_file, workers) as pool:
+                pool.sign_many(datas[:workers]) # warm up workers
+                start = time.time()
+                signed = pool.sign_many(datas, tags)
+                results[workers] = count / (time.time() - start)
+            assert all((di.verify() for di in signed[:4]))
+    print(json.dumps(dict(items = count, item_size = 100000, items_per_s = results), indent=2))
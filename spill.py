@@ -0,0 +1,167 @@
+import os, struct, threading
+
+class SpillQueue:
+    record = struct.Struct('<ddI') # pre_time, post_time, length
+    def __init__(self, path, budget, segment_size=64*1024*1024):
+        '''
+        An append-only on-disk queue of (pre_time, raw, post_time) reads,
+        for holding chunks that don't fit in memory until uploads catch up.
+
+        path: directory for segment files and the committed read position.
+              unconsumed reads left there by a previous run are resumed.
+        budget: maximum bytes of unconsumed reads to keep on disk; reads past it are dropped and counted
+        segment_size: bytes per segment file; consumed segments are deleted, and a
+                      segment that is consumed whole is closed early so it can be deleted too
+        '''
+        self.path = path
+        self.budget = budget
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.dropped_ct = 0
+        self.dropped_size = 0
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted((
+            int(name[:-4])
+            for name in os.listdir(path)
+            if name.endswith('.seg')
+        ))
+        try:
+            with open(os.path.join(path, 'head')) as fh:
+                segment, offset = map(int, fh.read().split())
+        except (FileNotFoundError, ValueError):
+            segment, offset = (self.segments[0] if len(self.segments) else 0), 0
+        self.committed = (segment, offset)
+        for old in [old for old in self.segments if old < segment]:
+            os.unlink(self._segment_path(old))
+            self.segments.remove(old)
+        self.size = sum((os.path.getsize(self._segment_path(existing)) for existing in self.segments))
+        # count what is left to read, and cut off a record torn by a crash
+        self.count = 0
+        for existing in self.segments:
+            offset = self.committed[1] if existing == self.committed[0] else 0
+            with open(self._segment_path(existing), 'r+b') as fh:
+                fh.seek(offset)
+                while True:
+                    header = fh.read(self.record.size)
+                    if len(header) == self.record.size:
+                        pre_time, post_time, length = self.record.unpack(header)
+                        if len(fh.read(length)) == length:
+                            self.count += 1
+                            offset = fh.tell()
+                            continue
+                    self.size -= fh.seek(0, 2) - offset
+                    fh.truncate(offset)
+                    break
+        if not len(self.segments):
+            self.segments.append(segment)
+        self.read_position = self.committed
+        self.writer = open(self._segment_path(self.segments[-1]), 'ab')
+        self.reader = None
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f'{segment:016d}.seg')
+    def __len__(self):
+        return self.count
+    @property
+    def position(self):
+        # pass to commit() once everything read so far is stored
+        return self.read_position
+    def dropped(self, reset = False):
+        with self.lock:
+            result = (self.dropped_ct, self.dropped_size)
+            if reset:
+                self.dropped_ct = 0
+                self.dropped_size = 0
+            return result
+    def append(self, item):
+        pre_time, raw, post_time = item
+        with self.lock:
+            # bytes before the committed position are consumed, and only wait for their segment to be deleted
+            if self.size - self.committed[1] + self.record.size + len(raw) > self.budget:
+                self.dropped_ct += 1
+                self.dropped_size += len(raw)
+                return False
+            if self.writer.tell() >= self.segment_size:
+                self.writer.close()
+                self.segments.append(self.segments[-1] + 1)
+                self.writer = open(self._segment_path(self.segments[-1]), 'ab')
+            self.writer.write(self.record.pack(pre_time, post_time, len(raw)))
+            self.writer.write(raw)
+            # flushed per record so a crash of this process loses nothing
+            self.writer.flush()
+            self.size += self.record.size + len(raw)
+            self.count += 1
+            return True
+    def read_many(self, max):
+        items = []
+        with self.lock:
+            segment, offset = self.read_position
+            while len(items) < max and self.count:
+                if self.reader is None or self.reader.name != self._segment_path(segment):
+                    if self.reader is not None:
+                        self.reader.close()
+                    self.reader = open(self._segment_path(segment), 'rb')
+                self.reader.seek(offset)
+                header = self.reader.read(self.record.size)
+                if not len(header):
+                    if segment >= self.segments[-1]:
+                        break
+                    segment += 1
+                    offset = 0
+                    continue
+                pre_time, post_time, length = self.record.unpack(header)
+                items.append((pre_time, self.reader.read(length), post_time))
+                offset = self.reader.tell()
+                self.count -= 1
+            self.read_position = (segment, offset)
+        return items
+    def commit(self, position):
+        # makes position the resume point, and frees segments before it
+        segment, offset = position
+        with self.lock:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            if segment == self.segments[-1] and offset and offset == self.writer.tell() and position == self.read_position:
+                # everything is consumed: later reads go to a new segment, so this one can be deleted
+                self.writer.close()
+                self.segments.append(segment + 1)
+                self.writer = open(self._segment_path(self.segments[-1]), 'ab')
+                segment, offset = position = self.read_position = (segment + 1, 0)
+            head_path = os.path.join(self.path, 'head')
+            with open(head_path + '.tmp', 'w') as fh:
+                fh.write(f'{segment} {offset}')
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(head_path + '.tmp', head_path)
+            self.committed = position
+            while self.segments[0] < segment:
+                old = self.segments.pop(0)
+                self.size -= os.path.getsize(self._segment_path(old))
+                os.unlink(self._segment_path(old))
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            if self.reader is not None:
+                self.reader.close()
+
+if __name__ == '__main__':
+    # cycles reads through a queue with a budget much smaller than a segment, checking none are dropped
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        spill = SpillQueue(tmpdir, 1000000)
+        for round in range(100):
+            for idx in range(5):
+                assert spill.append((round, bytes([idx]) * 100000, round)), f'dropped in round {round}'
+            raws = spill.read_many(5)
+            assert [raw[0] for pre_time, raw, post_time in raws] == list(range(5))
+            spill.commit(spill.position)
+        assert spill.dropped() == (0, 0)
+        assert spill.size <= 5 * (spill.record.size + 100000)
+        spill.close()
+        # reads left uncommitted are there again after a restart
+        spill = SpillQueue(tmpdir, 1000000)
+        spill.append((0, b'left', 0))
+        spill.close()
+        spill = SpillQueue(tmpdir, 1000000)
+        assert [raw for pre_time, raw, post_time in spill.read_many(5)] == [b'left']
+        spill.close()
+    print('ok')